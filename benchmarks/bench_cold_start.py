@@ -0,0 +1,115 @@
+"""
+Benchmark photo_access cold starts: each run is a fresh interpreter that
+imports the function module and serves one batch of thumbnail URLs whose
+renditions already exist (the common path), against a filesystem fake S3.
+
+'lazy' is the function as deployed, which doesn't load Pillow on the
+signing path. 'eager' imports Pillow and the rendition pipeline up front
+as the function did before, and reports how long those imports took on
+their own.
+
+Most of a cold start is the interpreter and boto3/botocore, which both
+modes load, so the difference between them is small. The Pillow imports
+are reported separately.
+
+Usage: python benchmarks/bench_cold_start.py [--runs N] [--images N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(__file__)
+bucket = 'peteandrew-photoarchive-eu'
+
+
+def child(mode, s3_dir, images):
+    start = time.perf_counter()
+    sys.path.insert(0, os.path.join(here, '..', 'lambda_layers', 'photo_archive', 'python'))
+    import importlib
+    import importlib.util
+
+    pillow_start = time.perf_counter()
+    if mode == 'eager':
+        for module in ['PIL.Image', 'PIL.ImageOps', 'photo_archive.generation']:
+            importlib.import_module(module)
+    pillow_done = time.perf_counter()
+
+    spec = importlib.util.spec_from_file_location(
+        'photo_access',
+        os.path.join(here, '..', 'lambda_functions', 'photo_access', 'lambda_function.py')
+    )
+    photo_access = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(photo_access)
+    imported = time.perf_counter()
+
+    import local_aws
+
+    photo_access.s3_client = local_aws.FakeS3(s3_dir)
+    event = {
+        'httpMethod': 'POST',
+        'body': json.dumps({
+            'image_type': 'thumbnail',
+            'images': [{'id': f'image-{n}', 'year': '2020', 'month': '01'} for n in range(images)],
+        }),
+    }
+    request_start = time.perf_counter()
+    result = photo_access.lambda_handler(event, None)
+    done = time.perf_counter()
+    assert result['statusCode'] == 200
+
+    print(json.dumps({
+        'import': (imported - start) * 1000,
+        'pillow': (pillow_done - pillow_start) * 1000,
+        'request': (done - request_start) * 1000,
+        'pil_loaded': 'PIL.Image' in sys.modules,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--images', type=int, default=50, help='thumbnails in the first request')
+    parser.add_argument('--child', choices=['lazy', 'eager'], help=argparse.SUPPRESS)
+    parser.add_argument('--s3-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.s3_dir, args.images)
+        return
+
+    env = dict(os.environ, AWS_DEFAULT_REGION='eu-west-2', METRICS_SAMPLE_RATE='0')
+    with tempfile.TemporaryDirectory() as s3_dir:
+        # Only existence is checked on the signing path
+        for n in range(args.images):
+            path = os.path.join(s3_dir, bucket, 'thumbnails', '2020', '01', f'image-{n}.jpg')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'wb').close()
+
+        print(f"{'mode':<6} {'process ms':>11} {'import ms':>10} {'Pillow ms':>10} {'request ms':>11}  Pillow loaded")
+        for mode in ['eager', 'lazy']:
+            process_times = []
+            results = []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                output = subprocess.run(
+                    [sys.executable, __file__, '--child', mode, '--s3-dir', s3_dir, '--images', str(args.images)],
+                    env=env, check=True, capture_output=True, text=True
+                ).stdout
+                process_times.append((time.perf_counter() - start) * 1000)
+                results.append(json.loads(output.strip().splitlines()[-1]))
+            print(
+                f"{mode:<6} {statistics.median(process_times):>11.1f} "
+                f"{statistics.median(result['import'] for result in results):>10.1f} "
+                f"{statistics.median(result['pillow'] for result in results):>10.1f} "
+                f"{statistics.median(result['request'] for result in results):>11.1f}  "
+                f"{results[0]['pil_loaded']}"
+            )
+
+
+if __name__ == '__main__':
+    main()
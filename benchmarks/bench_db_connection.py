@@ -0,0 +1,79 @@
+"""
+Benchmark warm photo_search latency with a new connection per request (the
+previous behaviour) against the reused connection and prepared statements
+in photo_archive.db.
+
+Usage: DB_CONN='host=... dbname=photo_bench sslmode=require' (a key/value DSN) python benchmarks/bench_db_connection.py
+Point DB_CONN at a remote database with TLS for representative numbers,
+against a local socket connection setup cost is much smaller.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import psycopg2
+
+here = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(here, '..', 'lambda_layers', 'photo_archive', 'python'))
+sys.path.insert(0, os.path.join(here, '..', 'lambda_functions', 'photo_search'))
+
+import search_query
+import seed
+
+from photo_archive import db
+
+filters = {'from_datetime': '2018-03-01 00:00:00', 'to_datetime': '2018-06-01 00:00:00'}
+
+
+def connect_per_request():
+    conn = psycopg2.connect(os.environ['DB_CONN'], options='-c search_path=bench')
+    with conn.cursor() as cur:
+        sql, params = search_query.page_query(filters, 100)
+        cur.execute(sql, params)
+        cur.fetchall()
+    conn.close()
+
+
+def reused_connection():
+    conn = db.get_connection()
+    with conn:
+        with conn.cursor() as cur:
+            sql, params = search_query.page_query(filters, 100)
+            db.execute_prepared(cur, sql, params)
+            cur.fetchall()
+
+
+def percentiles(fn, requests):
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DB_CONN'])
+    seed.seed_archive(conn, args.images)
+    conn.close()
+
+    # photo_archive.db connects with DB_CONN, run it against the bench schema
+    os.environ['DB_CONN'] += ' options=-csearch_path=bench'
+
+    for label, fn in [('connect per request', connect_per_request), ('reused + prepared', reused_connection)]:
+        p50, p95 = percentiles(fn, args.requests)
+        print(f"{label:<22} p50 {p50:>7.2f} ms  p95 {p95:>7.2f} ms")
+
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
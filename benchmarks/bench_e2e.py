@@ -0,0 +1,350 @@
+"""
+Run the lambda handlers end to end against local stand-ins: a filesystem
+backed fake S3 (benchmarks/local_aws.py) and a local Postgres loaded from
+schema.txt with a synthetic archive, and report per-stage timings
+(download, decode, resize, encode, upload, db) and throughput for each.
+
+Scenarios:
+  ingest      photo_upload_processor on a synthetic JPEG corpus
+  reimport    the same corpus uploaded again (skipped as duplicates)
+  metadata    photos_metadata_processor draining the queue, exif only
+  renditions  photos_metadata_processor regenerating renditions
+  access      photo_access batch URLs, with renditions missing then present,
+              and a page sprite built then read back from S3
+  search      photo_search queries against the seeded archive
+  tags        photo_tags single image and bulk updates
+  sign        photo_upload_access signing a batch of uploads
+
+Usage: DB_CONN='dbname=photo_bench' (a key/value DSN) python benchmarks/bench_e2e.py [--images N] [--uploads N]
+The benchmark creates and drops its own 'bench' schema in that database.
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+from urllib.parse import quote_plus
+
+import psycopg2
+
+here = os.path.dirname(__file__)
+functions_dir = os.path.join(here, '..', 'lambda_functions')
+sys.path.insert(0, os.path.join(here, '..', 'lambda_layers', 'photo_archive', 'python'))
+
+import local_aws
+import seed
+
+from bench_renditions import original_sizes
+
+stage_order = ['download', 'decode', 'resize', 'encode', 'upload', 'db', 'db connect', 's3', 'sign']
+
+
+def load_lambda(name):
+    """
+    Import a function's lambda_function module under its own name, with
+    its directory on the path for any modules alongside it
+    """
+    directory = os.path.join(functions_dir, name)
+    sys.path.insert(0, directory)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(directory, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_upload(width, height, time_created, camera, rng):
+    """
+    A JPEG with exif date and camera, the noise differs on every call so
+    each upload has different content
+    """
+    from PIL import Image
+
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), rng.randrange(20, 60))
+    image = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+    make, model = camera.split(' Model ')
+    exif = Image.Exif()
+    exif[0x010F] = make
+    exif[0x0110] = 'Model ' + model
+    exif[0x0132] = time_created.strftime('%Y:%m:%d %H:%M:%S')
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=92, exif=exif)
+    return buffer.getvalue()
+
+
+def upload_record(bucket, key):
+    return {'s3': {'bucket': {'name': bucket}, 'object': {'key': quote_plus(key), 'eTag': key}}}
+
+
+def report(label, stages, wall_seconds, items, unit):
+    totals = stages.snapshot()
+    rate = items / wall_seconds if wall_seconds > 0 else 0
+    print(f"\n{label}: {items} {unit} in {wall_seconds:.2f} s ({rate:.1f} {unit}/s)")
+    for stage in stage_order + sorted(set(totals) - set(stage_order)):
+        if stage not in totals:
+            continue
+        total, count = totals[stage]
+        print(
+            f"  {stage:<11} {total * 1000:>10.1f} ms total {count:>7} calls "
+            f"{total * 1000 / max(items, 1):>9.2f} ms/{unit.rstrip('s')}"
+        )
+
+
+@contextlib.contextmanager
+def scenario(label, stages, items, unit):
+    stages.reset()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+    report(label, stages, time.perf_counter() - start, items, unit)
+
+
+def latencies(handler, events, requests):
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for n in range(requests):
+            start = time.perf_counter()
+            result = handler(events[n % len(events)], local_aws.FakeContext())
+            timings.append((time.perf_counter() - start) * 1000)
+            if result['statusCode'] != 200:
+                raise RuntimeError(result['body'])
+    timings.sort()
+    return statistics.median(timings), timings[max(int(len(timings) * 0.95) - 1, 0)]
+
+
+def search_event(params, multi=None):
+    return {
+        'queryStringParameters': params,
+        'multiValueQueryStringParameters': multi or {},
+        'headers': {'Accept-Encoding': 'gzip, br'},
+    }
+
+
+def search_results(handler, event):
+    """
+    Number of images (or months for a summary) a search returns, requested
+    uncompressed
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = handler(dict(event, headers={}), local_aws.FakeContext())
+    if result['statusCode'] != 200:
+        raise RuntimeError(result['body'])
+    body = json.loads(result['body'])
+    return len(body.get('images') or body.get('ids') or body.get('months') or [])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=10000, help='rows in the synthetic archive')
+    parser.add_argument('--uploads', type=int, default=20, help='JPEGs in the upload corpus')
+    parser.add_argument('--size', default='12MP', choices=[label for label, _, _ in original_sizes])
+    parser.add_argument('--batch', type=int, default=10, help='S3 records per upload processor event')
+    parser.add_argument('--requests', type=int, default=50, help='requests per search/tags scenario')
+    parser.add_argument('--s3-dir', help='directory for the fake S3 (default: a temporary directory)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DB_CONN'])
+    image_ids = seed.seed_archive(conn, args.images, seed=args.seed)
+    # The most and least used tags in the seeded archive
+    with conn, conn.cursor() as cur:
+        cur.execute(
+            "select value from bench.facet_counts where facet = 'tag' and image_count > 0 "
+            "order by image_count desc, value"
+        )
+        seeded_tags = [row[0] for row in cur.fetchall()]
+    conn.close()
+    common_tag = seeded_tags[0]
+    rare_tag = seeded_tags[-1]
+
+    # The lambdas connect with DB_CONN, run them against the bench schema,
+    # and the Data API functions against the same database
+    os.environ['DB_CONN'] += ' options=-csearch_path=bench'
+    os.environ['DB_BACKEND'] = 'postgres'
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-2')
+
+    stages = local_aws.StageTimes()
+    local_aws.instrument(stages)
+
+    with contextlib.ExitStack() as stack:
+        s3_root = args.s3_dir or stack.enter_context(tempfile.TemporaryDirectory())
+        s3 = local_aws.FakeS3(s3_root, stages)
+
+        functions = {}
+        for name in [
+            'photo_upload_processor', 'photos_metadata_processor', 'photo_access',
+            'photo_search', 'photo_tags', 'photo_upload_access',
+        ]:
+            module = load_lambda(name)
+            if hasattr(module, 's3_client'):
+                module.s3_client = s3
+            if hasattr(module, 'lambda_client'):
+                module.lambda_client = local_aws.FakeLambda()
+            functions[name] = module
+
+        bucket = functions['photo_access'].bucket
+        rng = random.Random(args.seed)
+        width, height = next((w, h) for label, w, h in original_sizes if label == args.size)
+
+        print(f"Building {args.uploads} {args.size} uploads")
+        corpus = []
+        for n in range(args.uploads):
+            time_created = datetime(2014, 1, 1) + timedelta(seconds=rng.randrange(10 * 365 * 24 * 60 * 60))
+            corpus.append(synthetic_upload(width, height, time_created, rng.choice(seed.CAMERAS), rng))
+
+        def run_uploads(prefix):
+            keys = []
+            for n, data in enumerate(corpus):
+                key = f'uploads/{prefix}-{n:05}.jpg'
+                s3.write(s3.path(bucket, key), data)
+                keys.append(key)
+            results = []
+            for i in range(0, len(keys), args.batch):
+                event = {'Records': [upload_record(bucket, key) for key in keys[i:i + args.batch]]}
+                results.append(functions['photo_upload_processor'].lambda_handler(event, local_aws.FakeContext()))
+            return results
+
+        with scenario('ingest', stages, len(corpus), 'images'):
+            results = run_uploads('bench')
+        print(f"  processed {sum(result['processed'] for result in results)}, "
+              f"failed {sum(len(result['failed']) for result in results)}")
+
+        with scenario('reimport', stages, len(corpus), 'images'):
+            results = run_uploads('again')
+        print(f"  duplicates {sum(len(result.get('duplicates', {})) for result in results)}")
+
+        conn = psycopg2.connect(os.environ['DB_CONN'])
+        with conn, conn.cursor() as cur:
+            cur.execute("select id, time_created from images where source_key like 'uploads/bench-%' order by id")
+            ingested = cur.fetchall()
+        conn.close()
+
+        def queue_ingested():
+            conn = psycopg2.connect(os.environ['DB_CONN'])
+            with conn, conn.cursor() as cur:
+                cur.execute('delete from image_process_queue')
+                cur.executemany(
+                    'insert into image_process_queue (image_id) values (%s)',
+                    [(image_id,) for image_id, _ in ingested]
+                )
+            conn.close()
+
+        metadata_processor = functions['photos_metadata_processor']
+        queue_ingested()
+        with scenario('metadata', stages, len(ingested), 'images'):
+            metadata_processor.lambda_handler({}, local_aws.FakeContext())
+
+        queue_ingested()
+        with scenario('renditions', stages, len(ingested), 'images'):
+            metadata_processor.lambda_handler({'renditions': True}, local_aws.FakeContext())
+
+        photo_access = functions['photo_access']
+        access_event = {
+            'httpMethod': 'POST',
+            'body': json.dumps({
+                'image_type': 'thumbnail',
+                'images': [
+                    {'id': image_id, 'year': f'{time_created:%Y}', 'month': f'{time_created:%m}'}
+                    for image_id, time_created in ingested
+                ],
+            }),
+        }
+        for image_id, time_created in ingested:
+            s3.delete_object(
+                Bucket=bucket,
+                Key=photo_access.renditions.rendition_key('thumbnail', f'{time_created:%Y}', f'{time_created:%m}', image_id)
+            )
+        photo_access.present_keys.clear()
+        photo_access.signed_urls.clear()
+        with scenario('access, thumbnails missing', stages, len(ingested), 'images'):
+            photo_access.lambda_handler(access_event, local_aws.FakeContext())
+        photo_access.present_keys.clear()
+        photo_access.signed_urls.clear()
+        with scenario('access, cold caches', stages, len(ingested), 'images'):
+            photo_access.lambda_handler(access_event, local_aws.FakeContext())
+        with scenario('access, warm caches', stages, len(ingested), 'images'):
+            photo_access.lambda_handler(access_event, local_aws.FakeContext())
+
+        sprite_event = {
+            'httpMethod': 'POST',
+            'body': json.dumps(dict(json.loads(access_event['body']), action='sprite', format='webp')),
+        }
+        photo_access.sprite_maps.clear()
+        with scenario('access, sprite built', stages, len(ingested), 'images'):
+            result = photo_access.lambda_handler(sprite_event, local_aws.FakeContext())
+        if result['statusCode'] != 200 or len(json.loads(result['body'])['images']) != len(ingested):
+            raise RuntimeError(f"sprite request failed: {result['body']}")
+        photo_access.sprite_maps.clear()
+        with scenario('access, sprite stored', stages, len(ingested), 'images'):
+            photo_access.lambda_handler(sprite_event, local_aws.FakeContext())
+
+        photo_search = functions['photo_search']
+        search_scenarios = [
+            ('latest page', [search_event({})]),
+            ('3 month range', [search_event({
+                'start_date': '2018-03-01T00:00:00.000Z',
+                'end_date': '2018-06-01T00:00:00.000Z',
+            })]),
+            ('3 month range, compact', [search_event({
+                'start_date': '2018-03-01T00:00:00.000Z',
+                'end_date': '2018-06-01T00:00:00.000Z',
+                'format': 'compact',
+            })]),
+            ('common tag', [search_event({'tag': common_tag}, {'tag': [common_tag]})]),
+            ('rare tag', [search_event({'tag': rare_tag}, {'tag': [rare_tag]})]),
+            ('photographer', [search_event({'photographer': seed.PHOTOGRAPHERS[1]})]),
+            ('month summary', [search_event({'summary': 'months'})]),
+        ]
+        for label, events in search_scenarios:
+            # Each scenario has to return rows to be timing a real search
+            results = search_results(photo_search.lambda_handler, events[0])
+            if results == 0:
+                raise RuntimeError(f'search, {label} returned no results')
+            stages.reset()
+            p50, p95 = latencies(photo_search.lambda_handler, events, args.requests)
+            db_total, db_count = stages.snapshot().get('db', (0.0, 0))
+            print(
+                f"\nsearch, {label} ({results} results): p50 {p50:.2f} ms p95 {p95:.2f} ms, "
+                f"db {db_total * 1000 / args.requests:.2f} ms in {db_count / args.requests:.1f} statements per request"
+            )
+
+        photo_tags = functions['photo_tags']
+        tag_events = [
+            {
+                'queryStringParameters': {'image_id': image_id},
+                'body': json.dumps(rng.sample(seed.TAGS[:20], 3)),
+            }
+            for image_id in rng.sample(image_ids, min(len(image_ids), args.requests))
+        ]
+        stages.reset()
+        p50, p95 = latencies(photo_tags.lambda_handler, tag_events, args.requests)
+        print(f"\ntags, single image: p50 {p50:.2f} ms p95 {p95:.2f} ms")
+
+        bulk_ids = rng.sample(image_ids, min(len(image_ids), photo_tags.max_bulk_images))
+        bulk_events = [
+            {'body': json.dumps({'image_ids': bulk_ids, 'add': ['bench-bulk']})},
+            {'body': json.dumps({'image_ids': bulk_ids, 'remove': ['bench-bulk']})},
+        ]
+        p50, p95 = latencies(photo_tags.lambda_handler, bulk_events, 10)
+        print(f"tags, bulk {len(bulk_ids)} images: p50 {p50:.2f} ms p95 {p95:.2f} ms")
+
+        sign_event = {
+            'httpMethod': 'POST',
+            'body': json.dumps({
+                'files': [{'filename': f'IMG_{n:04}.JPG', 'size': 8 * 1024 * 1024} for n in range(50)],
+            }),
+        }
+        p50, p95 = latencies(functions['photo_upload_access'].lambda_handler, [sign_event], args.requests)
+        print(f"\nsign, 50 uploads: p50 {p50:.2f} ms p95 {p95:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Micro-benchmark of rendition generation on synthetic JPEG originals.
+
+Compares the previous approach (full decode, resize the original separately
+for each rendition, exif_transpose after resizing, save via /tmp) with the
+shared single-pass pipeline in photo_archive.renditions, for the JPEG
+thumbnail and standard renditions. Then times every configured rendition
+(including the RENDITION_FORMATS / RENDITION_SIZES variants) and compares
+the bytes of each variant with the JPEG rendition of the same size.
+
+Usage: python benchmarks/bench_renditions.py [--runs N]
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageOps
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(__file__), '..', 'lambda_layers', 'photo_archive', 'python')
+)
+
+from photo_archive import renditions
+
+# (label, width, height)
+original_sizes = [
+    ('6MP', 3000, 2000),
+    ('12MP', 4000, 3000),
+    ('24MP', 6000, 4000),
+    ('48MP', 8000, 6000),
+]
+
+
+def synthetic_jpeg(width, height):
+    """
+    Build a JPEG with enough detail (gradients plus noise) that encode and
+    decode costs are representative of a photo
+    """
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    image = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: rotated 90 CW
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=92, exif=exif)
+    return buffer.getvalue()
+
+
+legacy_types = ['thumbnail', 'standard']
+
+
+def legacy_resize(image, image_type):
+    new_longest_side = renditions.image_longest_sides[image_type]
+    new_size = renditions.new_size(image.size, new_longest_side)
+    return ImageOps.exif_transpose(image.resize(new_size, Image.BICUBIC))
+
+
+def legacy_renditions(data, tmp_dir):
+    sizes = {}
+    with Image.open(io.BytesIO(data)) as image:
+        for image_type in legacy_types:
+            target_path = os.path.join(tmp_dir, 'resized.jpg')
+            legacy_resize(image, image_type).save(target_path)
+            with open(target_path, 'rb') as f:
+                sizes[image_type] = len(f.read())
+    return sizes
+
+
+def pipeline_renditions(data, tmp_dir):
+    rendered = renditions.generate_renditions(io.BytesIO(data), legacy_types)
+    return {image_type: len(rendition) for image_type, rendition in rendered.items()}
+
+
+def all_renditions(data, tmp_dir):
+    rendered = renditions.generate_renditions(io.BytesIO(data))
+    return {image_type: len(rendition) for image_type, rendition in rendered.items()}
+
+
+def time_runs(fn, data, runs, tmp_dir):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        sizes = fn(data, tmp_dir)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), sizes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'original':>8} {'legacy ms':>10} {'pipeline ms':>12} {'speedup':>8}  rendition bytes (legacy / pipeline)")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for label, width, height in original_sizes:
+            data = synthetic_jpeg(width, height)
+            legacy_time, legacy_sizes = time_runs(legacy_renditions, data, args.runs, tmp_dir)
+            pipeline_time, pipeline_sizes = time_runs(pipeline_renditions, data, args.runs, tmp_dir)
+            size_summary = ', '.join(
+                f"{image_type} {legacy_sizes[image_type]} / {pipeline_sizes[image_type]}"
+                for image_type in legacy_types
+            )
+            print(
+                f"{label:>8} {legacy_time * 1000:>10.1f} {pipeline_time * 1000:>12.1f} "
+                f"{legacy_time / pipeline_time:>7.1f}x  {size_summary}"
+            )
+
+            all_time, all_sizes = time_runs(all_renditions, data, args.runs, tmp_dir)
+            print(f"{'':>8} all {len(all_sizes)} renditions {all_time * 1000:.1f} ms")
+            for image_type in legacy_types:
+                longest_side = renditions.rendition_specs[image_type]['longest_side']
+                for image_format in renditions.variant_formats:
+                    variant = renditions.variant_type(image_format, longest_side)
+                    if variant in all_sizes:
+                        print(
+                            f"{'':>8} {variant:<12} {all_sizes[variant]:>9} bytes "
+                            f"({all_sizes[variant] / all_sizes[image_type]:.0%} of {image_type})"
+                        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Benchmark photo_search queries against a seeded local Postgres.
+
+Compares the previous join-based SQL (tags x metadata fan-out, deduplicated
+in Python) with the exists()/aggregating queries in search_query.
+
+Usage: DB_CONN='dbname=photo_bench' python benchmarks/bench_search.py [--images N] [--runs N]
+The benchmark creates and drops its own 'bench' schema in that database.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_functions', 'photo_search'))
+
+import search_query
+import seed
+
+IMAGES_PER_PAGE = 100
+
+scenarios = [
+    ('3 month range', {'from_datetime': '2018-03-01 00:00:00', 'to_datetime': '2018-06-01 00:00:00'}, 0),
+    ('3 month range, page 5', {'from_datetime': '2018-03-01 00:00:00', 'to_datetime': '2018-06-01 00:00:00'}, 5),
+    ('all images, page 500', {}, 500),
+    ('common tag', {'tags': ['tag0']}, 0),
+    ('rare tag', {'tags': ['tag150']}, 0),
+    ('two tags', {'tags': ['tag0', 'tag1']}, 0),
+    ('photographer + range', {
+        'photographer': seed.PHOTOGRAPHERS[1],
+        'from_datetime': '2016-01-01 00:00:00',
+        'to_datetime': '2017-01-01 00:00:00',
+    }, 0),
+]
+
+
+def legacy_where(filters):
+    where_clauses = []
+    where_params = {}
+    if 'from_datetime' in filters:
+        where_clauses.append('time_created >= %(from_datetime)s')
+        where_params['from_datetime'] = filters['from_datetime']
+    if 'to_datetime' in filters:
+        where_clauses.append('time_created < %(to_datetime)s')
+        where_params['to_datetime'] = filters['to_datetime']
+    tag_num = 1
+    for tag in filters.get('tags', []):
+        where_clauses.append(f'tag = %(tag_{tag_num})s')
+        where_params[f'tag_{tag_num}'] = tag
+        tag_num += 1
+    if 'photographer' in filters:
+        where_clauses.append("im.type = 'photographer' and im.value = %(photographer)s")
+        where_params['photographer'] = filters['photographer']
+    return search_query.where_sql(where_clauses), where_params
+
+
+def legacy_search(cur, filters, page):
+    where, params = legacy_where(filters)
+    cur.execute(
+        "select i2.id, i2.time_created, it2.tag, im2.type, im2.value "
+        "from images i2 "
+        "left join image_tag it2 on it2.image_id = i2.id "
+        "left join image_metadata im2 on im2.image_id = i2.id "
+        "where i2.id in ("
+        "select id from ("
+        "select distinct i.id, i.time_created "
+        "from images i "
+        "left join image_tag it on it.image_id = i.id "
+        "left join image_metadata im on im.image_id = i.id "
+        + where +
+        "order by i.time_created "
+        f"limit {IMAGES_PER_PAGE} "
+        f"offset {page * IMAGES_PER_PAGE}"
+        ") page"
+        ")"
+        "order by i2.time_created",
+        params
+    )
+    images = {}
+    for record in cur.fetchall():
+        image = images.setdefault(record[0], {'tags': {}, 'metadata': {}})
+        if record[2] is not None:
+            image['tags'][record[2]] = True
+        if record[3] is not None and record[4] is not None:
+            image['metadata'][record[3]] = record[4]
+
+    cur.execute(
+        "select count(distinct i.id) "
+        "from images i "
+        "left join image_tag it on it.image_id = i.id "
+        "left join image_metadata im on im.image_id = i.id "
+        + where,
+        params
+    )
+    return len(images), cur.fetchone()[0]
+
+
+def new_search(cur, filters, page):
+    sql, params = search_query.page_query(filters, IMAGES_PER_PAGE, page * IMAGES_PER_PAGE)
+    cur.execute(sql, params)
+    num_rows = len(cur.fetchall())
+    sql, params = search_query.count_query(filters)
+    cur.execute(sql, params)
+    return num_rows, cur.fetchone()[0]
+
+
+def time_runs(fn, cur, filters, page, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn(cur, filters, page)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=100000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--keep', action='store_true', help="don't drop the bench schema afterwards")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DB_CONN'])
+    print(f"Seeding {args.images} images...")
+    seed.seed_archive(conn, args.images)
+
+    print(f"{'scenario':<24} {'legacy ms':>10} {'new ms':>8} {'speedup':>8}  rows/matched (legacy | new)")
+    with conn.cursor() as cur:
+        for label, filters, page in scenarios:
+            legacy_time, legacy_result = time_runs(legacy_search, cur, filters, page, args.runs)
+            new_time, new_result = time_runs(new_search, cur, filters, page, args.runs)
+            print(
+                f"{label:<24} {legacy_time * 1000:>10.1f} {new_time * 1000:>8.1f} "
+                f"{legacy_time / new_time:>7.1f}x  {legacy_result[0]}/{legacy_result[1]} | {new_result[0]}/{new_result[1]}"
+            )
+
+    if not args.keep:
+        with conn.cursor() as cur:
+            cur.execute('drop schema bench cascade')
+        conn.commit()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""
+Local stand-ins for the AWS services the lambdas use, so their handlers can
+be run against a directory on disk and a local Postgres.
+
+FakeS3 implements the subset of the S3 client API the functions call,
+storing objects as files under root/<bucket>/<key>. StageTimes collects
+time spent per stage (download, decode, resize, encode, upload, db, ...)
+from the fake clients and from wrappers installed by instrument().
+"""
+import hashlib
+import io
+import os
+import threading
+import time
+import types
+import uuid
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+
+class StageTimes:
+    """
+    Total time and count per stage. Stages are timed in whichever thread
+    runs them, so with concurrent workers totals can exceed wall time.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    def add(self, stage, seconds):
+        with self.lock:
+            total, count = self.totals.get(stage, (0.0, 0))
+            self.totals[stage] = (total + seconds, count + 1)
+
+    @contextmanager
+    def stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def reset(self):
+        with self.lock:
+            self.totals = {}
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.totals)
+
+
+def client_error(code, operation, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class FakeBody:
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, amt=None):
+        return self.stream.read(amt)
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self.stream.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self.stream.close()
+
+
+class FakeS3:
+    def __init__(self, root, stages=None):
+        self.root = root
+        self.stages = stages or StageTimes()
+        self.exceptions = types.SimpleNamespace(ClientError=ClientError)
+
+    def path(self, bucket, key):
+        if key.startswith('/') or '..' in key.split('/'):
+            raise client_error('InvalidKey', 'Object', key)
+        return os.path.join(self.root, bucket, key)
+
+    def object_info(self, path):
+        stat = os.stat(path)
+        return {
+            'ContentLength': stat.st_size,
+            'LastModified': datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+            # Not an MD5, but changes whenever the object is rewritten
+            'ETag': '"{size:x}-{mtime:x}"'.format(size=stat.st_size, mtime=stat.st_mtime_ns),
+        }
+
+    def write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '{path}.{id}.tmp'.format(path=path, id=uuid.uuid4().hex)
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        with self.stages.stage('download'):
+            path = self.path(Bucket, Key)
+            if not os.path.isfile(path):
+                raise client_error('NoSuchKey', 'GetObject', Key)
+            info = self.object_info(path)
+            with open(path, 'rb') as f:
+                if Range is None:
+                    data = f.read()
+                else:
+                    start, end = Range[len('bytes='):].split('-')
+                    if int(start) >= info['ContentLength']:
+                        raise client_error('InvalidRange', 'GetObject', Range)
+                    f.seek(int(start))
+                    data = f.read(int(end) - int(start) + 1)
+            return dict(info, Body=FakeBody(data), ContentLength=len(data))
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        Fileobj.write(self.get_object(Bucket=Bucket, Key=Key)['Body'].read())
+
+    def put_object(self, Bucket, Key, Body=b'', IfNoneMatch=None, **kwargs):
+        with self.stages.stage('upload'):
+            if isinstance(Body, str):
+                Body = Body.encode()
+            elif not isinstance(Body, bytes):
+                Body = Body.read()
+            path = self.path(Bucket, Key)
+            if IfNoneMatch == '*':
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+                except FileExistsError:
+                    raise client_error('PreconditionFailed', 'PutObject', Key)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(Body)
+            else:
+                self.write(path, Body)
+            return {'ETag': self.object_info(path)['ETag']}
+
+    def copy_object(self, Bucket, CopySource, Key, **kwargs):
+        with self.stages.stage('upload'):
+            source_path = self.path(CopySource['Bucket'], CopySource['Key'])
+            if not os.path.isfile(source_path):
+                raise client_error('NoSuchKey', 'CopyObject', CopySource['Key'])
+            with open(source_path, 'rb') as f:
+                self.write(self.path(Bucket, Key), f.read())
+            return {}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        with self.stages.stage('s3'):
+            path = self.path(Bucket, Key)
+            if not os.path.isfile(path):
+                raise client_error('404', 'HeadObject', 'Not Found')
+            return self.object_info(path)
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        with self.stages.stage('s3'):
+            path = self.path(Bucket, Key)
+            if os.path.isfile(path):
+                os.remove(path)
+            return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for obj in Delete['Objects']:
+            self.delete_object(Bucket=Bucket, Key=obj['Key'])
+        return {'Deleted': [{'Key': obj['Key']} for obj in Delete['Objects']]}
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, StartAfter=None, MaxKeys=1000, **kwargs):
+        with self.stages.stage('s3'):
+            bucket_root = os.path.join(self.root, Bucket)
+            keys = []
+            for directory, _, filenames in os.walk(bucket_root):
+                for filename in filenames:
+                    if filename.endswith('.tmp'):
+                        continue
+                    key = os.path.relpath(os.path.join(directory, filename), bucket_root).replace(os.sep, '/')
+                    if key.startswith(Prefix):
+                        keys.append(key)
+            keys.sort()
+            after = ContinuationToken or StartAfter
+            if after is not None:
+                keys = [key for key in keys if key > after]
+
+            page = keys[:MaxKeys]
+            result = {
+                'KeyCount': len(page),
+                'IsTruncated': len(keys) > MaxKeys,
+                'Contents': [
+                    dict(self.object_info(self.path(Bucket, key)), Key=key, Size=os.path.getsize(self.path(Bucket, key)))
+                    for key in page
+                ],
+            }
+            if result['IsTruncated']:
+                result['NextContinuationToken'] = page[-1]
+            return result
+
+    def get_paginator(self, operation):
+        if operation != 'list_objects_v2':
+            raise NotImplementedError(operation)
+        return FakePaginator(self.list_objects_v2)
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600, **kwargs):
+        with self.stages.stage('sign'):
+            signature = hashlib.sha256(repr((ClientMethod, sorted(Params.items()))).encode()).hexdigest()
+            return 'https://{bucket}.s3.local/{key}?X-Amz-Expires={expires}&X-Amz-Signature={signature}'.format(
+                bucket = Params['Bucket'],
+                key = Params['Key'],
+                expires = ExpiresIn,
+                signature = signature
+            )
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': uuid.uuid4().hex}
+
+    def abort_multipart_upload(self, **kwargs):
+        return {}
+
+
+class FakePaginator:
+    def __init__(self, list_objects):
+        self.list_objects = list_objects
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            page = self.list_objects(ContinuationToken=token, **kwargs)
+            yield page
+            if not page['IsTruncated']:
+                return
+            token = page['NextContinuationToken']
+
+
+class FakeLambda:
+    """
+    Records async invocations rather than running them
+    """
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, **kwargs):
+        self.invocations.append(kwargs)
+        return {'StatusCode': 202}
+
+    def remove_permission(self, **kwargs):
+        return {}
+
+
+class FakeContext:
+    def __init__(self, timeout_seconds=900):
+        self.deadline = time.monotonic() + timeout_seconds
+        self.invoked_function_arn = 'arn:aws:lambda:local:000000000000:function:bench'
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+
+def timed(stages, stage, fn):
+    def wrapper(*args, **kwargs):
+        with stages.stage(stage):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def instrument(stages):
+    """
+    Time the rendition pipeline stages and every statement on psycopg2
+    connections opened from now on
+    """
+    import psycopg2
+    import psycopg2.extensions
+
+    from photo_archive import renditions
+
+    open_original = renditions.open_original
+
+    # Pixel data is decoded lazily, load it straight away so decoding is
+    # timed on its own rather than inside whichever stage touches it first
+    def timed_open_original(*args, **kwargs):
+        image = open_original(*args, **kwargs)
+        with stages.stage('decode'):
+            image.load()
+        return image
+
+    renditions.open_original = timed_open_original
+    renditions.resize = timed(stages, 'resize', renditions.resize)
+    renditions.encode = timed(stages, 'encode', renditions.encode)
+
+    cursor_classes = {}
+
+    def timed_cursor(base):
+        if base not in cursor_classes:
+            class TimedCursor(base):
+                def execute(self, query, vars=None):
+                    with stages.stage('db'):
+                        return super().execute(query, vars)
+
+                def executemany(self, query, vars_list):
+                    with stages.stage('db'):
+                        return super().executemany(query, vars_list)
+
+            cursor_classes[base] = TimedCursor
+        return cursor_classes[base]
+
+    connect = psycopg2.connect
+
+    # photo_archive.db connects with its own cursor class, time statements
+    # in a subclass of whichever is used
+    def timed_connect(*args, **kwargs):
+        kwargs['cursor_factory'] = timed_cursor(kwargs.get('cursor_factory') or psycopg2.extensions.cursor)
+        with stages.stage('db connect'):
+            return connect(*args, **kwargs)
+
+    psycopg2.connect = timed_connect
@@ -0,0 +1,93 @@
+"""
+Create a synthetic archive in a local Postgres database for benchmarks.
+
+Tables are created from schema.txt in a dedicated schema, so benchmarks
+never touch existing tables in the database they're pointed at.
+"""
+import io
+import os
+import random
+import sys
+import uuid
+
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_layers', 'photo_archive', 'python'))
+
+from photo_archive import facets
+
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), '..', 'schema.txt')
+
+CAMERAS = [f'Camera Maker {n} Model {n * 10}' for n in range(20)]
+PHOTOGRAPHERS = [f'Photographer {n}' for n in range(8)]
+TAGS = [f'tag{n}' for n in range(200)]
+
+
+def schema_statements():
+    with open(SCHEMA_PATH) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def create_schema(conn, schema):
+    with conn.cursor() as cur:
+        cur.execute(f'drop schema if exists {schema} cascade')
+        cur.execute(f'create schema {schema}')
+        cur.execute(f'set search_path to {schema}')
+        for statement in schema_statements():
+            cur.execute(statement)
+    conn.commit()
+
+
+def copy_rows(cur, table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(str(value) for value in row) + '\n')
+    buffer.seek(0)
+    cur.copy_from(buffer, table, columns=columns)
+
+
+def seed_archive(conn, num_images, schema='bench', seed=1):
+    """
+    Create the schema and load num_images images spread over ten years,
+    each with camera metadata, most with a photographer and 0-5 tags
+    drawn from a skewed vocabulary, and build their facet counts as
+    tools/rebuild_facets.py does. Returns the list of image ids.
+    """
+    create_schema(conn, schema)
+    rng = random.Random(seed)
+    start = datetime(2014, 1, 1)
+    span_seconds = 10 * 365 * 24 * 60 * 60
+
+    image_rows = []
+    metadata_rows = []
+    tag_rows = []
+    for _ in range(num_images):
+        image_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        time_created = start + timedelta(seconds=rng.randrange(span_seconds))
+        image_rows.append((image_id, time_created, time_created, ''))
+
+        camera_num = rng.randrange(len(CAMERAS))
+        metadata_rows.append((image_id, 'camera', CAMERAS[camera_num]))
+        if rng.random() < 0.7:
+            metadata_rows.append((image_id, 'photographer', PHOTOGRAPHERS[camera_num % len(PHOTOGRAPHERS)]))
+
+        # Pareto-ish tag popularity, a few tags are very common
+        image_tags = {TAGS[min(int(rng.paretovariate(1.2)) - 1, len(TAGS) - 1)] for _ in range(rng.randrange(6))}
+        for tag in image_tags:
+            tag_rows.append((image_id, tag))
+
+    with conn.cursor() as cur:
+        copy_rows(cur, 'images', ('id', 'time_created', 'time_processed', 'original_directory'), image_rows)
+        copy_rows(cur, 'image_metadata', ('image_id', 'type', 'value'), metadata_rows)
+        copy_rows(cur, 'image_tag', ('image_id', 'tag'), tag_rows)
+        copy_rows(
+            cur,
+            'camera_photographer',
+            ('camera', 'photographer'),
+            [(camera, PHOTOGRAPHERS[n % len(PHOTOGRAPHERS)]) for n, camera in enumerate(CAMERAS)]
+        )
+        facets.rebuild_pg(cur)
+        cur.execute('analyze')
+    conn.commit()
+
+    return [row[0] for row in image_rows]
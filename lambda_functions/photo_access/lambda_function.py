@@ -1,96 +1,527 @@
 import json
+import os
+import threading
+import time
+import traceback
 import boto3
 import botocore
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from botocore.client import Config
-from PIL import Image, ImageOps
+
+# Only key naming is used from renditions and sprites on the signing path,
+# Pillow and photo_archive.generation are imported the first time a missing
+# rendition or a sprite is generated in this instance
+from photo_archive import metrics, renditions, sprites
 
 bucket = 'peteandrew-photoarchive-eu'
-image_longest_sides = {'thumbnail': 500, 'standard': 2000}
 
-s3_client = boto3.client(
+# Maximum number of images that can be requested in a single batch call and
+# the number of existence checks / renditions run concurrently for a batch
+max_batch_size = 100
+max_batch_workers = 16
+
+# Rendition keys known to exist, so repeat requests skip the head_object.
+# Renditions are never deleted, the TTL only bounds how stale the cache
+# can be if one is removed by hand.
+present_cache_size = 20000
+present_cache_seconds = 3600
+present_keys = OrderedDict()
+present_keys_lock = threading.Lock()
+
+# Missing renditions being generated by this instance, image key to an
+# Event set when generation finishes. Across instances generation is
+# guarded by a lock object in the bucket (see photo_archive.generation).
+generating = {}
+generating_lock = threading.Lock()
+wait_seconds = 10
+
+# With GENERATOR_FUNCTION set, missing renditions are generated by invoking
+# that function (photo_rendition_generator) asynchronously and no URL is
+# returned for them meanwhile, so this function never loads Pillow.
+# Requests are sent at most once per key per generator_request_seconds by
+# an instance. Originals are never signed in place of a rendition.
+generator_function = os.environ.get('GENERATOR_FUNCTION')
+generator_request_seconds = 120
+generator_requests = {}
+lambda_client = None
+
+# Variant formats in order of preference, the first one the client asks
+# for (with a format parameter or the Accept header) that is configured in
+# renditions.variant_formats is served. Variants are made at ingest or by
+# tools/backfill_renditions.py, a missing one is never generated while the
+# client waits: the JPEG rendition is served and the variant requested
+# from GENERATOR_FUNCTION when that's set.
+format_preference = ['avif', 'webp', 'jpeg']
+
+# POST {"action": "sprite", "images": [...]} returns one sprite of the
+# images' thumbnails and a map of their positions, cached in S3. Maps of
+# sprites known to exist are kept in memory.
+sprite_cell_size = 200
+max_sprite_cell_size = renditions.image_longest_sides['thumbnail']
+sprite_cache_size = 1000
+sprite_maps = OrderedDict()
+sprite_maps_lock = threading.Lock()
+
+# Presigned URLs are reused for the rest of the time bucket they were
+# issued in. Each is valid for url_bucket_seconds + url_min_remaining_seconds
+# so one issued at the start of a bucket still has at least
+# url_min_remaining_seconds left when it's last handed out.
+#
+# URLs are only identical within one warm instance: the signature covers
+# X-Amz-Date, the time the URL was signed, and each instance signs (and
+# caches) on its own. A client served by another instance, or after a
+# cold start, gets a different URL for the same image and misses the
+# browser/CDN cache. botocore doesn't take a signing time, so pinning it
+# to the bucket start isn't done here.
+url_bucket_seconds = 3600
+url_min_remaining_seconds = 600
+url_cache_size = 20000
+signed_urls = OrderedDict()
+signed_urls_lock = threading.Lock()
+
+s3_client = metrics.instrument(boto3.client(
     's3',
     region_name='eu-west-2',
-    config=Config(signature_version='s3v4')
-)
+    config=Config(
+        signature_version='s3v4',
+        max_pool_connections=max_batch_workers,
+    )
+))
 
-def resize(image, image_type):
-    new_longest_side = image_longest_sides[image_type]
+def known_present(image_key):
+    with present_keys_lock:
+        expires = present_keys.get(image_key)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del present_keys[image_key]
+            return False
+        present_keys.move_to_end(image_key)
+        return True
 
-    if image.size[0] > image.size[1]:
-        width_longest = True
-        cur_longest_side = image.size[0]
-    else:
-        width_longest = False
-        cur_longest_side = image.size[1]
 
-    # If the current longest side is less than or equal to the new longest side
-    # then we don't need to do any resizing, return current size
-    if cur_longest_side <= new_longest_side:
-        new_size = image.size
-    else:
-        ratio = image.size[1] / image.size[0]
+def mark_present(image_key):
+    with present_keys_lock:
+        present_keys[image_key] = time.monotonic() + present_cache_seconds
+        present_keys.move_to_end(image_key)
+        while len(present_keys) > present_cache_size:
+            present_keys.popitem(last=False)
 
-        if width_longest:
-            new_size = (new_longest_side, round(new_longest_side * ratio))
-        else:
-            new_size = (round(new_longest_side / ratio), new_longest_side)
 
-    return ImageOps.exif_transpose(image.resize(new_size, Image.BICUBIC))
+def rendition_exists(image_key):
+    if known_present(image_key):
+        return True
+    try:
+        s3_client.head_object(Bucket=bucket, Key=image_key)
+    except botocore.exceptions.ClientError:
+        return False
+    mark_present(image_key)
+    return True
 
 
-def lambda_handler(event, context):
-    id = event['queryStringParameters']['id']
-    year = event['queryStringParameters']['year']
-    month = event['queryStringParameters']['month']
-    image_type = event['queryStringParameters']['image_type']
-    if image_type not in ('thumbnail', 'standard'):
-        image_type = 'thumbnail'
+def wait_for_rendition(image_key):
+    # Another instance of the function is generating the rendition
+    deadline = time.monotonic() + wait_seconds
+    while time.monotonic() < deadline:
+        time.sleep(0.5)
+        if rendition_exists(image_key):
+            return True
+    return False
+
 
-    folder = 'thumbnails' if image_type == 'thumbnail' else 'standard'
-    image_key = '{folder}/{year}/{month}/{id}.jpg'.format(
-        folder = folder,
-        year = year,
-        month = month,
-        id = id
+def request_generation(image_type, year, month, id, image_key):
+    """
+    Ask the generator function to create a missing rendition
+    """
+    global lambda_client
+
+    now = time.monotonic()
+    with generating_lock:
+        if generator_requests.get(image_key, 0) > now:
+            return
+        generator_requests[image_key] = now + generator_request_seconds
+        for key, expires in list(generator_requests.items()):
+            if expires <= now:
+                del generator_requests[key]
+        if lambda_client is None:
+            lambda_client = metrics.instrument(boto3.client('lambda', region_name='eu-west-2'))
+
+    lambda_client.invoke(
+        FunctionName=generator_function,
+        InvocationType='Event',
+        Payload=json.dumps({'image_type': image_type, 'year': year, 'month': month, 'id': id}),
     )
+
+
+def ensure_rendition(image_type, year, month, id):
+    """
+    Return the key to sign for the requested rendition, generating it
+    from the original if it doesn't exist yet, or None if it isn't
+    available. Only one request generates a missing rendition, the others
+    wait for it and return None if it isn't ready in time. With
+    GENERATOR_FUNCTION set None is returned while the generator creates
+    the rendition.
+    """
+    image_key = renditions.rendition_key(image_type, year, month, id)
+    if rendition_exists(image_key):
+        return image_key
+
+    if generator_function:
+        request_generation(image_type, year, month, id, image_key)
+        return None
+
+    # Requests in this instance (e.g. a batch) wait for the first one
+    with generating_lock:
+        generated = generating.get(image_key)
+        leader = generated is None
+        if leader:
+            generated = threading.Event()
+            generating[image_key] = generated
+
+    if not leader:
+        generated.wait(wait_seconds)
+        return image_key if known_present(image_key) else None
+
     try:
-        s3_client.head_object(Bucket=bucket, Key=image_key)
-    except botocore.exceptions.ClientError as e:
-        source_key = 'originals/{year}/{month}/{id}.jpg'.format(
-            year = year,
-            month = month,
-            id = id
-        )
-        source_path = '/tmp/original_{id}.jpg'.format(id=id)
-        target_path = '/tmp/resized_{id}.jpg'.format(id=id)
-        s3_client.download_file(bucket, source_key, source_path)
-
-        with Image.open(source_path) as image:
-            new_image = resize(image, image_type)
-            new_image.save(target_path)
-
-        s3_client.upload_file(
-            target_path,
-            bucket,
-            image_key,
-            ExtraArgs={'ContentType': 'image/jpeg'}
-        )
+        from photo_archive import generation
+
+        if not generation.acquire_lock(s3_client, bucket, image_key):
+            return image_key if wait_for_rendition(image_key) else None
+        try:
+            generation.generate(s3_client, bucket, image_type, year, month, id)
+        finally:
+            generation.release_lock(s3_client, bucket, image_key)
+        mark_present(image_key)
+    finally:
+        with generating_lock:
+            del generating[image_key]
+        generated.set()
+
+    return image_key
+
+
+def jpeg_rendition(image_type):
+    """
+    Return the JPEG rendition (thumbnail or standard) to serve in place of
+    a variant, the smallest at least as large
+    """
+    if image_type in renditions.image_longest_sides:
+        return image_type
+    longest_side = renditions.rendition_specs[image_type]['longest_side']
+    covering = [
+        jpeg_type
+        for jpeg_type, jpeg_longest_side in sorted(renditions.image_longest_sides.items(), key=lambda item: item[1])
+        if jpeg_longest_side >= longest_side
+    ]
+    return covering[0] if len(covering) > 0 else 'standard'
+
+
+def serve_rendition(image_type, year, month, id):
+    """
+    Return the key to sign for the rendition chosen for a request, or None.
+    A missing variant is requested from the generator and the JPEG
+    rendition served instead.
+    """
+    if image_type in renditions.image_longest_sides:
+        return ensure_rendition(image_type, year, month, id)
+
+    image_key = renditions.rendition_key(image_type, year, month, id)
+    if rendition_exists(image_key):
+        return image_key
 
+    metrics.count('missing_variants')
+    if generator_function:
+        request_generation(image_type, year, month, id, image_key)
+    return ensure_rendition(jpeg_rendition(image_type), year, month, id)
+
+
+def presigned_url(image_key):
+    """
+    Return a presigned URL for the key, reusing the URL already issued
+    by this instance in the current time bucket so repeat views it serves
+    get an identical URL the browser (and any CDN) can serve from its cache
+    """
+    now = time.time()
+    time_bucket = int(now // url_bucket_seconds)
+    with signed_urls_lock:
+        cached = signed_urls.get(image_key)
+        if cached is not None and cached[0] == time_bucket and cached[2] - now >= url_min_remaining_seconds:
+            signed_urls.move_to_end(image_key)
+            return cached[1]
+
+    # Signing is done locally by botocore, no request is made to S3
+    expires_in = url_bucket_seconds + url_min_remaining_seconds
     url = s3_client.generate_presigned_url(
         ClientMethod='get_object',
         Params={
             'Bucket': bucket,
-            'Key': image_key
+            'Key': image_key,
+            'ResponseCacheControl': 'max-age={expires_in}'.format(expires_in=expires_in),
         },
-        ExpiresIn=600
+        ExpiresIn=expires_in
+    )
+
+    with signed_urls_lock:
+        signed_urls[image_key] = (time_bucket, url, now + expires_in)
+        signed_urls.move_to_end(image_key)
+        while len(signed_urls) > url_cache_size:
+            signed_urls.popitem(last=False)
+    return url
+
+
+def batch_urls(images, image_type):
+    """
+    Return a dict of image id to presigned URL for a list of images,
+    each a dict with id, year and month. Existence checks (and any
+    missing renditions) are run concurrently. An image whose rendition
+    can't be found or generated (e.g. a missing or corrupt original) has
+    a null URL rather than failing the whole batch.
+    """
+    if len(images) == 0:
+        return {}
+
+    def image_rendition(image):
+        try:
+            return serve_rendition(image_type, image['year'], image['month'], image['id'])
+        except Exception:
+            print(f"Failed to get {image_type} for {image['id']}")
+            traceback.print_exc()
+            metrics.count('failed')
+            return None
+
+    workers = min(max_batch_workers, len(images))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        image_keys = list(executor.map(image_rendition, images))
+
+    return {
+        image['id']: presigned_url(image_key) if image_key is not None else None
+        for image, image_key in zip(images, image_keys)
+    }
+
+
+def cached_sprite_map(key):
+    """
+    Return the map of a sprite that has been built, or None
+    """
+    with sprite_maps_lock:
+        sprite_map = sprite_maps.get(key)
+        if sprite_map is not None:
+            sprite_maps.move_to_end(key)
+            return sprite_map
+
+    try:
+        with metrics.stage('download'):
+            stored = s3_client.get_object(Bucket=bucket, Key=sprites.map_key(key))
+            sprite_map = json.loads(stored['Body'].read())
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return None
+
+    cache_sprite_map(key, sprite_map)
+    return sprite_map
+
+
+def cache_sprite_map(key, sprite_map):
+    with sprite_maps_lock:
+        sprite_maps[key] = sprite_map
+        sprite_maps.move_to_end(key)
+        while len(sprite_maps) > sprite_cache_size:
+            sprite_maps.popitem(last=False)
+
+
+def build_sprite(images, key, cell_size, image_format):
+    """
+    Build a sprite from the images' thumbnails, generating any that are
+    missing. Images whose thumbnail isn't available are left out of the
+    sprite, which is then not cached so a later request can complete it.
+    The sprite is stored before its map, so a stored map means the sprite
+    exists.
+    """
+    def image_thumbnail(image):
+        image_key = ensure_rendition('thumbnail', image['year'], image['month'], image['id'])
+        if image_key is None:
+            return None
+        with metrics.stage('download'):
+            return s3_client.get_object(Bucket=bucket, Key=image_key)['Body'].read()
+
+    workers = min(max_batch_workers, len(images))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        thumbnails = list(executor.map(image_thumbnail, images))
+
+    available = [
+        (image['id'], thumbnail)
+        for image, thumbnail in zip(images, thumbnails)
+        if thumbnail is not None
+    ]
+    data, sprite_map = sprites.build(available, cell_size, image_format)
+
+    spec = renditions.variant_format_specs[image_format]
+    with metrics.stage('upload'):
+        s3_client.put_object(Bucket=bucket, Key=key, Body=data, ContentType=spec['content_type'])
+    if len(available) == len(images):
+        with metrics.stage('upload'):
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=sprites.map_key(key),
+                Body=json.dumps(sprite_map),
+                ContentType='application/json'
+            )
+        cache_sprite_map(key, sprite_map)
+    return sprite_map
+
+
+def page_sprite(images, cell_size, image_format):
+    """
+    Return (key, map) of the sprite for a list of images, building it if
+    it doesn't exist
+    """
+    key = sprites.sprite_key([image['id'] for image in images], cell_size, image_format)
+    sprite_map = cached_sprite_map(key)
+    if sprite_map is None:
+        sprite_map = build_sprite(images, key, cell_size, image_format)
+    return key, sprite_map
+
+
+def accepted_formats(event, requested_format):
+    if requested_format:
+        return [requested_format]
+    headers = event.get('headers') or {}
+    accept = ''
+    for name, value in headers.items():
+        if name.lower() == 'accept' and value:
+            accept = value
+    media_types = {media_type.split(';')[0].strip() for media_type in accept.split(',')}
+    return [
+        image_format
+        for image_format in format_preference
+        if renditions.variant_format_specs[image_format]['content_type'] in media_types
+    ]
+
+
+def choose_rendition(image_type, size, formats):
+    """
+    Return the rendition to serve for a requested image type: the smallest
+    variant in the first acceptable format at least size (by default the
+    image type's size) on its longest side, or the image type itself if
+    no variant format is acceptable
+    """
+    if size is None:
+        size = renditions.rendition_specs[image_type]['longest_side']
+    for image_format in formats:
+        if image_format in renditions.variant_formats and len(renditions.variant_sizes) > 0:
+            covering = [variant_size for variant_size in renditions.variant_sizes if variant_size >= size]
+            variant_size = covering[0] if len(covering) > 0 else renditions.variant_sizes[-1]
+            return renditions.variant_type(image_format, variant_size)
+    return image_type
+
+
+def requested_size(value):
+    if value is None or value == '':
+        return None
+    size = int(value)
+    if size <= 0:
+        raise ValueError('size must be positive')
+    return size
+
+
+def requested_images(request):
+    """
+    Return (images, None) for the list of {id, year, month} in a batch
+    request body, or (None, error message)
+    """
+    images = request.get('images', [])
+    if len(images) > max_batch_size:
+        return None, f'A maximum of {max_batch_size} images can be requested'
+    try:
+        images = [
+            {'id': str(image['id']), 'year': image['year'], 'month': image['month']}
+            for image in images
+        ]
+    except (KeyError, TypeError):
+        return None, 'Each image requires id, year and month'
+    return images, None
+
+
+def sprite_response(event, request):
+    images, error = requested_images(request)
+    if error is not None:
+        return response(400, {'error': error})
+    if len(images) == 0:
+        return response(400, {'error': 'At least one image is required'})
+    try:
+        cell_size = min(requested_size(request.get('size')) or sprite_cell_size, max_sprite_cell_size)
+    except (TypeError, ValueError):
+        return response(400, {'error': 'size must be a positive number of pixels'})
+    image_format = next(
+        (
+            image_format
+            for image_format in accepted_formats(event, request.get('format'))
+            if image_format in sprites.sprite_formats
+        ),
+        'jpeg'
     )
 
+    key, sprite_map = page_sprite(images, cell_size, image_format)
+    return response(200, dict(sprite_map, url=presigned_url(key)))
+
+
+def response(status_code, body):
     return {
-        'statusCode': 200,
+        'statusCode': status_code,
         'headers': {
             'Access-Control-Allow-Headers': '*',
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
         },
-        'body': json.dumps({'url': url})
+        'body': json.dumps(body)
     }
+
+
+@metrics.handler('photo_access')
+def lambda_handler(event, context):
+    # POST with a JSON body of images returns URLs for a whole page
+    # of search results in one request, or with "action": "sprite" a
+    # single sprite of their thumbnails
+    if event.get('httpMethod') == 'POST':
+        request = json.loads(event['body'] or '{}')
+        if request.get('action') == 'sprite':
+            return sprite_response(event, request)
+
+        image_type = request.get('image_type')
+        if image_type not in renditions.rendition_specs:
+            image_type = 'thumbnail'
+        try:
+            size = requested_size(request.get('size'))
+        except (TypeError, ValueError):
+            return response(400, {'error': 'size must be a positive number of pixels'})
+        image_type = choose_rendition(image_type, size, accepted_formats(event, request.get('format')))
+
+        images, error = requested_images(request)
+        if error is not None:
+            return response(400, {'error': error})
+
+        return response(200, {'urls': batch_urls(images, image_type)})
+
+    id = event['queryStringParameters']['id']
+    year = event['queryStringParameters']['year']
+    month = event['queryStringParameters']['month']
+    image_type = event['queryStringParameters']['image_type']
+    if image_type not in renditions.rendition_specs:
+        image_type = 'thumbnail'
+    try:
+        size = requested_size(event['queryStringParameters'].get('size'))
+    except ValueError:
+        return response(400, {'error': 'size must be a positive number of pixels'})
+    image_type = choose_rendition(
+        image_type,
+        size,
+        accepted_formats(event, event['queryStringParameters'].get('format'))
+    )
+
+    image_key = serve_rendition(image_type, year, month, id)
+    if image_key is None:
+        return response(503, {'error': 'The image is being prepared, try again shortly'})
+
+    return response(200, {'url': presigned_url(image_key)})
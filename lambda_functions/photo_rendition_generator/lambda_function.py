@@ -0,0 +1,45 @@
+import boto3
+import botocore
+
+from photo_archive import generation, metrics, renditions
+
+bucket = 'peteandrew-photoarchive-eu'
+
+s3_client = metrics.instrument(boto3.client(
+    's3',
+    region_name='eu-west-2'
+))
+
+def rendition_exists(image_key):
+    try:
+        s3_client.head_object(Bucket=bucket, Key=image_key)
+    except botocore.exceptions.ClientError:
+        return False
+    return True
+
+@metrics.handler('photo_rendition_generator')
+def lambda_handler(event, context):
+    """
+    Generate a missing rendition, invoked asynchronously by photo_access
+    (when its GENERATOR_FUNCTION is set) with {image_type, year, month, id}
+    """
+    image_type = event['image_type']
+    year = event['year']
+    month = event['month']
+    id = event['id']
+    if image_type not in renditions.rendition_specs:
+        return {'generated': False}
+
+    # Another request may have generated it since it was found missing
+    image_key = renditions.rendition_key(image_type, year, month, id)
+    if rendition_exists(image_key):
+        return {'generated': False}
+
+    if not generation.acquire_lock(s3_client, bucket, image_key):
+        return {'generated': False}
+    try:
+        generation.generate(s3_client, bucket, image_type, year, month, id)
+    finally:
+        generation.release_lock(s3_client, bucket, image_key)
+
+    return {'generated': True}
@@ -1,15 +1,154 @@
+import base64
+import binascii
 import json
 import math
 import os
+import time
 
+from collections import OrderedDict
 from datetime import datetime
 
-import psycopg2
+import search_query
+import search_response
+
+from photo_archive import db, metrics
 
 
 IMAGES_PER_PAGE = 100
 
+# Exact counts are cached for warm invocations, keyed on the search filters,
+# keeping the COUNT_CACHE_SIZE most recently used
+COUNT_CACHE_SECONDS = 300
+COUNT_CACHE_SIZE = 1000
+COUNT_MODES = ('exact', 'estimate', 'none')
+
+count_cache = OrderedDict()
+
 
+HEADERS = {
+    'Access-Control-Allow-Headers': '*',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
+}
+
+
+def response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': dict(HEADERS),
+        'body': body
+    }
+
+
+def encode_cursor(time_created, image_id):
+    cursor = json.dumps([str(time_created), image_id])
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Return the (time_created, id) of the last image on the previous page,
+    or None for the first page. Raises ValueError if the cursor is invalid.
+    """
+    if not cursor:
+        return None
+    try:
+        time_created, image_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, TypeError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError('Invalid cursor') from e
+    return time_created, image_id
+
+
+def count_images(conn, filters, count_mode):
+    """
+    Return the number of images matching the filters. 'exact' counts are
+    cached for COUNT_CACHE_SECONDS, 'estimate' uses the query planner's row
+    estimate and 'none' skips counting.
+    """
+    if count_mode == 'none':
+        return None
+
+    if count_mode == 'estimate':
+        sql, params = search_query.estimate_query(filters)
+        # explain can't be run as a prepared statement
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            plan = cur.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    sql, params = search_query.count_query(filters)
+    cache_key = (sql, tuple(sorted(params.items())))
+    cached = count_cache.get(cache_key)
+    if cached is not None and cached[1] > time.monotonic():
+        count_cache.move_to_end(cache_key)
+        return cached[0]
+
+    with conn.cursor() as cur:
+        db.execute_prepared(cur, sql, params)
+        num_images_matched = cur.fetchone()[0]
+
+    count_cache[cache_key] = (num_images_matched, time.monotonic() + COUNT_CACHE_SECONDS)
+    count_cache.move_to_end(cache_key)
+    while len(count_cache) > COUNT_CACHE_SIZE:
+        count_cache.popitem(last=False)
+    return num_images_matched
+
+
+def fetch_page(conn, filters, offset, cursor, page):
+    """
+    Add a page of images matching the filters to the page builder,
+    streaming rows from the cursor straight into it
+    """
+    if search_query.is_time_range(filters):
+        # Time range searches page through the time_created index on images
+        # only, then load tags and metadata for just the page's images
+        sql, params = search_query.time_range_query(filters, IMAGES_PER_PAGE, offset, cursor)
+        with conn.cursor() as cur:
+            db.execute_prepared(cur, sql, params)
+            for image_id, time_created, width, height, placeholder in cur:
+                page.add_image(image_id, time_created, width, height, placeholder)
+        if len(page) == 0:
+            return
+
+        image_ids = page.ids()
+        with conn.cursor() as cur:
+            sql, params = search_query.page_tags_query(image_ids)
+            db.execute_prepared(cur, sql, params)
+            for image_id, tag in cur:
+                page.add_tag(image_id, tag)
+
+            sql, params = search_query.page_metadata_query(image_ids)
+            db.execute_prepared(cur, sql, params)
+            for image_id, metadata_type, metadata_value in cur:
+                page.add_metadata(image_id, metadata_type, metadata_value)
+        return
+
+    sql, params = search_query.page_query(filters, IMAGES_PER_PAGE, offset, cursor)
+
+    # Each row is one image with its tags and metadata already aggregated
+    with conn.cursor() as cur:
+        db.execute_prepared(cur, sql, params)
+        for image_id, time_created, width, height, placeholder, tags, metadata in cur:
+            page.add_image(image_id, time_created, width, height, placeholder, tags, metadata)
+
+
+def month_summary(event, filters):
+    """
+    Number of images per month, from the month facet counts (built for
+    existing images by tools/rebuild_facets.py)
+    """
+    sql, params = search_query.month_summary_query(filters)
+    conn = db.get_connection()
+    with conn:
+        with conn.cursor() as cur:
+            db.execute_prepared(cur, sql, params)
+            months = [{'month': month, 'count': image_count} for month, image_count in cur]
+    return search_response.encode(event, 200, {'months': months}, HEADERS)
+
+
+@metrics.handler('photo_search')
 def lambda_handler(event, context):
     if 'DB_CONN' not in os.environ:
         print("DB_CONN environment variable not set")
@@ -23,144 +162,84 @@ def lambda_handler(event, context):
             'body': 'Could not connect to database'
         }
 
-    where_clauses = []
-    where_params = {}
+    filters = {}
+    offset = 0
+    # Passing a cursor (empty for the first page) selects keyset pagination,
+    # otherwise pages are selected with page / offset
+    keyset = False
+    cursor = None
+    count_mode = 'exact'
+    # format=compact returns columns with dictionary encoded metadata
+    page_format = 'list'
     if event['queryStringParameters']:
+        if 'format' in event['queryStringParameters']:
+            page_format = event['queryStringParameters']['format']
+            if page_format not in search_response.PAGE_FORMATS:
+                return response(400, json.dumps({'error': f'format must be one of {", ".join(search_response.PAGE_FORMATS)}'}))
         if 'start_date' in event['queryStringParameters']:
             from_datetime = datetime.strptime(event['queryStringParameters']['start_date'], "%Y-%m-%dT%H:%M:00.000Z")
-            where_clauses.append('time_created >= %(from_datetime)s')
-            where_params['from_datetime'] = str(from_datetime)
+            filters['from_datetime'] = str(from_datetime)
         if 'end_date' in event['queryStringParameters']:
             to_datetime = datetime.strptime(event['queryStringParameters']['end_date'], "%Y-%m-%dT%H:%M:00.000Z")
-            where_clauses.append('time_created < %(to_datetime)s')
-            where_params['to_datetime'] = str(to_datetime)
+            filters['to_datetime'] = str(to_datetime)
         if 'tag' in event['multiValueQueryStringParameters']:
-            tag_num = 1
-            for tag in event['multiValueQueryStringParameters']['tag']:
-                where_clauses.append(f'tag = %(tag_{tag_num})s')
-                where_params[f'tag_{tag_num}'] = tag
-                tag_num += 1
+            filters['tags'] = event['multiValueQueryStringParameters']['tag']
         if 'photographer' in event['queryStringParameters']:
-            photographer = event['queryStringParameters']['photographer']
-            where_clauses.append("im.type = 'photographer' and im.value = %(photographer)s")
-            where_params['photographer'] = photographer
-        if 'page' in event['queryStringParameters']:
+            filters['photographer'] = event['queryStringParameters']['photographer']
+        if 'cursor' in event['queryStringParameters']:
+            keyset = True
+            count_mode = 'none'
+            try:
+                cursor = decode_cursor(event['queryStringParameters']['cursor'])
+            except ValueError:
+                return response(400, json.dumps({'error': 'Invalid cursor'}))
+        elif 'page' in event['queryStringParameters']:
             offset = int(event['queryStringParameters']['page']) * IMAGES_PER_PAGE
-        else:
-            offset = 0
-
-    sql = (
-        "select i2.id, i2.time_created, it2.tag, im2.type, im2.value "
-        "from images i2 "
-        "left join image_tag it2 on it2.image_id = i2.id "
-        "left join image_metadata im2 on im2.image_id = i2.id "
-        "where i2.id in ("
-        "select id from ("
-        "select distinct i.id, i.time_created "
-        "from images i "
-        "left join image_tag it on it.image_id = i.id "
-        "left join image_metadata im on im.image_id = i.id "
-
-    )
-    if len(where_clauses) > 0:
-        sql += "where "
-        previous_clause = False
-        for where_clause in where_clauses:
-            if previous_clause:
-                sql += "and "
-            sql += where_clause + " "
-            previous_clause = True
-    sql += (
-        "order by i.time_created "
-        f"limit {IMAGES_PER_PAGE} "
-        f"offset {offset}"
-        ")"
-        ")"
-        "order by i2.time_created"
-    )
-
-    # print()
-    # print(sql)
-    # print()
-    # print(where_params)
-    # print()
-
-    conn = psycopg2.connect(os.environ['DB_CONN'])
-
-    with conn.cursor() as cur:
-        cur.execute(sql, where_params)
-        records = cur.fetchall()
-
-    images = {}
-    for record in records:
-        image_id = record[0]
-        if image_id not in images:
-            images[image_id] = {
-                'id': image_id,
-                'timeCreated': str(record[1]),
-                'tags': {},
-                'metadata': {},
-            }
-
-        if record[2] is not None:
-            tag = record[2]
-            images[image_id]['tags'][tag] = True
-
-        if record[3] is not None and record[4] is not None:
-            metadata_type = record[3]
-            metadata_value = record[4]
-            images[image_id]['metadata'][metadata_type] = metadata_value
-
-    images_list = list(
-        map(lambda image: {
-            **image,
-            'tags': list(image['tags'].keys())
-        }, images.values())
-    )
+        if 'count' in event['queryStringParameters']:
+            count_mode = event['queryStringParameters']['count']
+            if count_mode not in COUNT_MODES:
+                return response(400, json.dumps({'error': f'count must be one of {", ".join(COUNT_MODES)}'}))
 
+    # summary=months returns a per month timeline instead of images
+    if event['queryStringParameters'] and event['queryStringParameters'].get('summary') == 'months':
+        return month_summary(event, filters)
 
-    sql = (
-        "select count(distinct i.id) "
-        "from images i "
-        "left join image_tag it on it.image_id = i.id "
-        "left join image_metadata im on im.image_id = i.id "
+    include_facets = bool(
+        event['queryStringParameters'] and event['queryStringParameters'].get('facets')
     )
-    if len(where_clauses) > 0:
-        sql += "where "
-        previous_clause = False
-        for where_clause in where_clauses:
-            if previous_clause:
-                sql += "and "
-            sql += where_clause + " "
-            previous_clause = True
-
-    # print()
-    # print(sql)
-    # print()
-    # print(where_params)
-    # print()
 
-    with conn.cursor() as cur:
-        cur.execute(sql, where_params)
-        result = cur.fetchone()
-        num_images_matched = result[0]
-
-    conn.close()
-
-    # print(f"Num images matched: {num_images_matched}")
-    # print(f"Num images returned: {len(images_list)}")
-    # print()
-
-    return {
-        'statusCode': 200,
-        'headers': {
-            'Access-Control-Allow-Headers': '*',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
-        },
-        'body': json.dumps({
-            'images': images_list,
-            'images_matched': num_images_matched,
-            'pages': math.ceil(num_images_matched / IMAGES_PER_PAGE),
-        })
-    }
\ No newline at end of file
+    conn = db.get_connection()
+
+    with conn:
+        # Facet counts for the tags order the tag filters so the most
+        # selective is tested first
+        if len(filters.get('tags', [])) > 1:
+            sql, params = search_query.facet_filter_query(filters)
+            with conn.cursor() as cur:
+                db.execute_prepared(cur, sql, params)
+                facet_counts = {(record[0], record[1]): record[2] for record in cur}
+            filters = search_query.plan_filters(filters, facet_counts)
+
+        page = search_response.PAGE_FORMATS[page_format]()
+        fetch_page(conn, filters, offset, cursor, page)
+        num_images_matched = count_images(conn, filters, count_mode)
+
+        if include_facets:
+            facets = {'tag': {}, 'photographer': {}, 'month': {}}
+            with conn.cursor() as cur:
+                db.execute_prepared(cur, search_query.facets_query())
+                for facet, value, image_count in cur:
+                    facets.setdefault(facet, {})[value] = image_count
+
+    body = page.body()
+    if include_facets:
+        body['facets'] = facets
+    if keyset:
+        body['next_cursor'] = None
+        if len(page) == IMAGES_PER_PAGE:
+            body['next_cursor'] = encode_cursor(*page.last())
+    if num_images_matched is not None:
+        body['images_matched'] = num_images_matched
+        body['pages'] = math.ceil(num_images_matched / IMAGES_PER_PAGE)
+
+    return search_response.encode(event, 200, body, HEADERS)
@@ -0,0 +1,212 @@
+"""
+SQL generation for photo searches.
+
+Filters are applied to images with exists() semi-joins, so an image is
+never multiplied by its tags or metadata rows while filtering, and each
+tag filter must match its own image_tag row (all tags must be present).
+Tags and metadata for the page are aggregated per image, one row each.
+
+filters is a dict that may contain from_datetime, to_datetime,
+tags (a list) and photographer.
+"""
+from datetime import datetime, timedelta
+
+
+def filter_clauses(filters):
+    where_clauses = []
+    where_params = {}
+
+    if filters.get('from_datetime') is not None:
+        where_clauses.append('i.time_created >= %(from_datetime)s')
+        where_params['from_datetime'] = filters['from_datetime']
+    if filters.get('to_datetime') is not None:
+        where_clauses.append('i.time_created < %(to_datetime)s')
+        where_params['to_datetime'] = filters['to_datetime']
+
+    tag_num = 1
+    for tag in filters.get('tags', []):
+        where_clauses.append(
+            'exists (select 1 from image_tag it '
+            f'where it.image_id = i.id and it.tag = %(tag_{tag_num})s)'
+        )
+        where_params[f'tag_{tag_num}'] = tag
+        tag_num += 1
+
+    if filters.get('photographer') is not None:
+        where_clauses.append(
+            'exists (select 1 from image_metadata im '
+            "where im.image_id = i.id and im.type = 'photographer' and im.value = %(photographer)s)"
+        )
+        where_params['photographer'] = filters['photographer']
+
+    return where_clauses, where_params
+
+
+def where_sql(where_clauses):
+    if len(where_clauses) == 0:
+        return ""
+    return "where " + "and ".join(where_clause + " " for where_clause in where_clauses)
+
+
+def page_query(filters, limit, offset=0, cursor=None):
+    """
+    Return (sql, params) selecting a page of images ordered by
+    (time_created, id) as rows of id, time_created, width, height,
+    placeholder, tags (list) and metadata (dict). cursor is the (time_created, id) of the last image
+    on the previous page for keyset pagination.
+    """
+    where_clauses, where_params = filter_clauses(filters)
+    if cursor is not None:
+        where_clauses.append('(i.time_created, i.id) > (%(cursor_time)s, %(cursor_id)s)')
+        where_params['cursor_time'] = cursor[0]
+        where_params['cursor_id'] = cursor[1]
+
+    # The page is selected first so tags and metadata are only
+    # aggregated for the images returned
+    sql = (
+        "select page.id, page.time_created, page.width, page.height, page.placeholder, "
+        "array(select it.tag from image_tag it where it.image_id = page.id order by it.tag), "
+        "coalesce(("
+        "select json_object_agg(im.type, im.value) "
+        "from image_metadata im where im.image_id = page.id"
+        "), '{}'::json) "
+        "from ("
+        "select i.id, i.time_created, i.width, i.height, i.placeholder "
+        "from images i "
+    )
+    sql += where_sql(where_clauses)
+    sql += (
+        "order by i.time_created, i.id "
+        "limit %(limit)s "
+        "offset %(offset)s"
+        ") page "
+        "order by page.time_created, page.id"
+    )
+    where_params['limit'] = int(limit)
+    where_params['offset'] = int(offset)
+    return sql, where_params
+
+
+def count_query(filters):
+    where_clauses, where_params = filter_clauses(filters)
+    return "select count(*) from images i " + where_sql(where_clauses), where_params
+
+
+def estimate_query(filters):
+    where_clauses, where_params = filter_clauses(filters)
+    return "explain (format json) select 1 from images i " + where_sql(where_clauses), where_params
+
+
+def facet_filter_query(filters):
+    """
+    Return (sql, params) selecting facet_counts rows of (facet, value,
+    image_count) for the tag and photographer filters
+    """
+    sql = (
+        "select facet, value, image_count from facet_counts "
+        "where (facet = 'tag' and value = any(%(facet_tags)s)) "
+        "or (facet = 'photographer' and value = %(facet_photographer)s)"
+    )
+    return sql, {
+        'facet_tags': list(filters.get('tags', [])),
+        'facet_photographer': filters.get('photographer'),
+    }
+
+
+def filter_facets(filters):
+    pairs = [('tag', tag) for tag in filters.get('tags', [])]
+    if filters.get('photographer') is not None:
+        pairs.append(('photographer', filters['photographer']))
+    return pairs
+
+
+def plan_filters(filters, facet_counts):
+    """
+    Use facet counts ({(facet, value): image_count}) to order a search's
+    tag filters, most selective first. The counts are only a hint, a
+    missing or stale count never skips the query or stands in for the
+    number of matching images.
+    """
+    planned = dict(filters)
+    if len(filters.get('tags', [])) > 1:
+        planned['tags'] = sorted(filters['tags'], key=lambda tag: facet_counts.get(('tag', tag), 0))
+    return planned
+
+
+def facets_query():
+    return (
+        "select facet, value, image_count from facet_counts "
+        "where image_count > 0 "
+        "order by facet, image_count desc, value"
+    )
+
+
+def is_time_range(filters):
+    """
+    True when a search only filters on time created, which can be
+    answered from the images (time_created, id) index alone
+    """
+    return len(filter_facets(filters)) == 0
+
+
+def time_range_query(filters, limit, offset=0, cursor=None):
+    """
+    Return (sql, params) selecting a page of (id, time_created, width,
+    height, placeholder) rows for a time range search, tags and metadata are loaded separately for the
+    page's ids with page_tags_query and page_metadata_query
+    """
+    where_clauses, where_params = filter_clauses(filters)
+    if cursor is not None:
+        where_clauses.append('(i.time_created, i.id) > (%(cursor_time)s, %(cursor_id)s)')
+        where_params['cursor_time'] = cursor[0]
+        where_params['cursor_id'] = cursor[1]
+
+    sql = (
+        "select i.id, i.time_created, i.width, i.height, i.placeholder from images i "
+        + where_sql(where_clauses)
+    )
+    sql += (
+        "order by i.time_created, i.id "
+        "limit %(limit)s "
+        "offset %(offset)s"
+    )
+    where_params['limit'] = int(limit)
+    where_params['offset'] = int(offset)
+    return sql, where_params
+
+
+def page_tags_query(image_ids):
+    return (
+        "select image_id, tag from image_tag where image_id = any(%(ids)s) order by image_id, tag",
+        {'ids': list(image_ids)},
+    )
+
+
+def page_metadata_query(image_ids):
+    return (
+        "select image_id, type, value from image_metadata where image_id = any(%(ids)s)",
+        {'ids': list(image_ids)},
+    )
+
+
+def month_summary_query(filters):
+    """
+    Return (sql, params) selecting (month, image_count) rows from the
+    month facet counts, limited to the months the time filters overlap.
+    to_datetime is exclusive as it is for image searches, so a range
+    ending at the start of a month doesn't include that month.
+    """
+    sql = (
+        "select value, image_count from facet_counts "
+        "where facet = 'month' and image_count > 0 "
+        "and value >= %(from_month)s and value <= %(to_month)s "
+        "order by value"
+    )
+    from_month = '0000-00'
+    to_month = '9999-99'
+    if filters.get('from_datetime') is not None:
+        from_month = str(filters['from_datetime'])[:7]
+    if filters.get('to_datetime') is not None:
+        last_included = datetime.fromisoformat(str(filters['to_datetime'])) - timedelta(microseconds=1)
+        to_month = last_included.strftime('%Y-%m')
+    return sql, {'from_month': from_month, 'to_month': to_month}
@@ -0,0 +1,172 @@
+"""
+Building and encoding photo search responses.
+
+Pages are built in a single pass over the query results, either as the
+default list of image objects or, with format=compact, as columns with
+metadata values dictionary encoded (each distinct camera / photographer
+appears once, images refer to it by index).
+
+Each image has its width and height and a base64 JPEG placeholder (null
+for images processed before these were recorded) so the gallery can lay
+out and draw the page before thumbnails load.
+"""
+import base64
+import gzip
+import json
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Compressed bodies are returned base64 encoded, which API Gateway only
+# decodes when binary media types are enabled for the API, so compression
+# is turned on with COMPRESS_RESPONSES=1 once that's configured
+COMPRESS_RESPONSES = os.environ.get('COMPRESS_RESPONSES') == '1'
+
+# Bodies smaller than this aren't worth compressing
+MIN_COMPRESS_BYTES = 1024
+
+
+class ListPage:
+    def __init__(self):
+        self.images = []
+        self.by_id = {}
+
+    def __len__(self):
+        return len(self.images)
+
+    def add_image(self, image_id, time_created, width=None, height=None, placeholder=None, tags=None, metadata=None):
+        image = {
+            'id': image_id,
+            'timeCreated': str(time_created),
+            'width': width,
+            'height': height,
+            'placeholder': placeholder,
+            'tags': tags if tags is not None else [],
+            'metadata': metadata if metadata is not None else {},
+        }
+        self.images.append(image)
+        self.by_id[image_id] = image
+
+    def add_tag(self, image_id, tag):
+        self.by_id[image_id]['tags'].append(tag)
+
+    def add_metadata(self, image_id, metadata_type, value):
+        self.by_id[image_id]['metadata'][metadata_type] = value
+
+    def ids(self):
+        return list(self.by_id)
+
+    def last(self):
+        image = self.images[-1]
+        return image['timeCreated'], image['id']
+
+    def body(self):
+        return {'images': self.images}
+
+
+class CompactPage:
+    def __init__(self):
+        self.image_ids = []
+        self.times_created = []
+        self.widths = []
+        self.heights = []
+        self.placeholders = []
+        self.tags = []
+        self.index = {}
+        # metadata type to {'values': [...], 'codes': {value: code}, 'images': [code or None, ...]}
+        self.metadata = {}
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def add_image(self, image_id, time_created, width=None, height=None, placeholder=None, tags=None, metadata=None):
+        self.index[image_id] = len(self.image_ids)
+        self.image_ids.append(image_id)
+        self.times_created.append(str(time_created))
+        self.widths.append(width)
+        self.heights.append(height)
+        self.placeholders.append(placeholder)
+        self.tags.append(tags if tags is not None else [])
+        for column in self.metadata.values():
+            column['images'].append(None)
+        for metadata_type, value in (metadata or {}).items():
+            self.add_metadata(image_id, metadata_type, value)
+
+    def add_tag(self, image_id, tag):
+        self.tags[self.index[image_id]].append(tag)
+
+    def add_metadata(self, image_id, metadata_type, value):
+        column = self.metadata.get(metadata_type)
+        if column is None:
+            column = {'values': [], 'codes': {}, 'images': [None] * len(self.image_ids)}
+            self.metadata[metadata_type] = column
+        code = column['codes'].get(value)
+        if code is None:
+            code = len(column['values'])
+            column['codes'][value] = code
+            column['values'].append(value)
+        column['images'][self.index[image_id]] = code
+
+    def ids(self):
+        return list(self.image_ids)
+
+    def last(self):
+        return self.times_created[-1], self.image_ids[-1]
+
+    def body(self):
+        return {
+            'format': 'compact',
+            'ids': self.image_ids,
+            'timeCreated': self.times_created,
+            'width': self.widths,
+            'height': self.heights,
+            'placeholder': self.placeholders,
+            'tags': self.tags,
+            'metadata': {
+                metadata_type: {'values': column['values'], 'images': column['images']}
+                for metadata_type, column in self.metadata.items()
+            },
+        }
+
+
+PAGE_FORMATS = {'list': ListPage, 'compact': CompactPage}
+
+
+def accepted_encodings(event):
+    headers = event.get('headers') or {}
+    for name, value in headers.items():
+        if name.lower() == 'accept-encoding' and value:
+            return {encoding.split(';')[0].strip() for encoding in value.split(',')}
+    return set()
+
+
+def encode(event, status_code, body, headers):
+    """
+    Return an API Gateway response for a dict body, compressed with brotli
+    (when available) or gzip if enabled and the client accepts it
+    """
+    data = json.dumps(body, separators=(',', ':'))
+    response = {
+        'statusCode': status_code,
+        'headers': dict(headers, **{'Content-Type': 'application/json', 'Vary': 'Accept-Encoding'}),
+        'body': data,
+    }
+    if not COMPRESS_RESPONSES or len(data) < MIN_COMPRESS_BYTES:
+        return response
+
+    encodings = accepted_encodings(event)
+    if brotli is not None and 'br' in encodings:
+        compressed = brotli.compress(data.encode(), quality=5)
+        response['headers']['Content-Encoding'] = 'br'
+    elif 'gzip' in encodings:
+        compressed = gzip.compress(data.encode(), compresslevel=6)
+        response['headers']['Content-Encoding'] = 'gzip'
+    else:
+        return response
+
+    response['body'] = base64.b64encode(compressed).decode()
+    response['isBase64Encoded'] = True
+    return response
@@ -1,56 +1,105 @@
 import boto3
 import json
 
-rds_client = boto3.client('rds-data')
+from collections import Counter
+
+from photo_archive import backends, facets, metrics
+
+rds_client = metrics.instrument(boto3.client('rds-data'))
 
 cluster_arn = 'arn:aws:rds:eu-west-2:306578912108:cluster:database-1'
 secret_arn = 'arn:aws:secretsmanager:eu-west-2:306578912108:secret:rds-db-credentials/cluster-QBRFG6NNVJEGKYGGMCDHRUGXVA/admin-F2AjV8' 
 database = 'photoarchive'
 
-def lambda_handler(event, context):
-    print(event)
-
-    image_id = event['queryStringParameters']['image_id']
-    tags = json.loads(event['body'])
-    print(tags)
-
-    rds_client.execute_statement(
-        resourceArn = cluster_arn,
-        secretArn = secret_arn,
-        database = database,
-        sql = 'delete from image_tag where image_id = :id',
-        parameters = [
-            {
-                'name': 'id',
-                'value': {'stringValue': image_id}
-            },
-        ]
-    )
-
-    for tag in tags:
-        print(tag)
-        rds_client.execute_statement(
-            resourceArn = cluster_arn,
-            secretArn = secret_arn,
-            database = database,
-            sql = 'insert into image_tag (image_id, tag) values (:id, :tag)',
-            parameters = [
-                {
-                    'name': 'id',
-                    'value': {'stringValue': image_id}
-                },
-                {
-                    'name': 'tag',
-                    'value': {'stringValue': tag}
-                },
-            ]
-        )
+max_bulk_images = 1000
 
+def response(status_code, body):
     return {
-        'statusCode': 200,
+        'statusCode': status_code,
         'headers': {
             'Access-Control-Allow-Headers': '*',
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Methods': 'OPTIONS,PUT,GET',
         },
-    }
\ No newline at end of file
+        'body': json.dumps(body),
+    }
+
+def clean_tags(tags):
+    # Empty tags (e.g. from an empty tags input) are ignored, others are
+    # kept as sent so existing tags match
+    return {tag for tag in tags if tag.strip()}
+
+def current_tags(tx, image_ids):
+    """
+    Return a dict of image id to its set of tags. The images are locked
+    until the transaction ends, so concurrent changes to the same images'
+    tags are applied one after another and each counts only the rows it
+    actually adds or removes.
+    """
+    params = {f'id_{num}': image_id for num, image_id in enumerate(image_ids)}
+    ids = ', '.join(f':{name}' for name in params)
+    tx.query(f'select id from images where id in ({ids}) order by id for update', params)
+    sql = f'select image_id, tag from image_tag where image_id in ({ids})'
+    tags = {image_id: set() for image_id in image_ids}
+    for image_id, tag in tx.query(sql, params):
+        tags[image_id].add(tag)
+    return tags
+
+def apply_changes(tx, removals, additions):
+    """
+    Remove and add (image id, tag) pairs with one batched statement each
+    and update the tag facet counts to match
+    """
+    tx.execute_batch(
+        'delete from image_tag where image_id = :id and tag = :tag',
+        [{'id': image_id, 'tag': tag} for image_id, tag in removals]
+    )
+    tx.execute_batch(
+        'insert into image_tag (image_id, tag) values (:id, :tag) on conflict do nothing',
+        [{'id': image_id, 'tag': tag} for image_id, tag in additions]
+    )
+
+    tag_deltas = Counter()
+    for _, tag in removals:
+        tag_deltas[(facets.TAG, tag)] -= 1
+    for _, tag in additions:
+        tag_deltas[(facets.TAG, tag)] += 1
+    facets.apply(tx, tag_deltas)
+
+@metrics.handler('photo_tags')
+def lambda_handler(event, context):
+    request = json.loads(event['body'])
+    image_id = (event.get('queryStringParameters') or {}).get('image_id')
+
+    backend = backends.get_backend(rds_client, cluster_arn, secret_arn, database)
+
+    # PUT ?image_id=... with a list of tags replaces that image's tags
+    if image_id is not None:
+        tags = clean_tags(request)
+        with backend.transaction() as tx:
+            existing = current_tags(tx, [image_id])[image_id]
+            removals = [(image_id, tag) for tag in sorted(existing - tags)]
+            additions = [(image_id, tag) for tag in sorted(tags - existing)]
+            apply_changes(tx, removals, additions)
+
+        return response(200, {'added': len(additions), 'removed': len(removals)})
+
+    # Bulk mode, PUT with {"image_ids": [...], "add": [...], "remove": [...]}
+    # adds and removes tags on many images at once
+    image_ids = list(dict.fromkeys(request.get('image_ids', [])))
+    if len(image_ids) > max_bulk_images:
+        return response(400, {'error': f'A maximum of {max_bulk_images} images can be updated'})
+    add_tags = clean_tags(request.get('add', []))
+    remove_tags = clean_tags(request.get('remove', [])) - add_tags
+
+    removals = []
+    additions = []
+    if len(image_ids) > 0:
+        with backend.transaction() as tx:
+            existing = current_tags(tx, image_ids)
+            for image_id in image_ids:
+                removals += [(image_id, tag) for tag in sorted(existing[image_id] & remove_tags)]
+                additions += [(image_id, tag) for tag in sorted(add_tags - existing[image_id])]
+            apply_changes(tx, removals, additions)
+
+    return response(200, {'added': len(additions), 'removed': len(removals)})
@@ -1,37 +1,151 @@
 import json
+import math
 import boto3
 from botocore.client import Config
 
+from photo_archive import metrics
+
 bucket = 'peteandrew-photoarchive-eu'
 
-s3_client = boto3.client(
+# Maximum number of files that can be signed in one request
+max_batch_size = 100
+
+# Files larger than this are uploaded in parts with a presigned URL per part.
+# Only JPEGs are imported (upload.html skips other files and
+# photo_upload_processor only decodes JPEG), so in practice this is only
+# used for unusually large JPEGs, not RAW/HEIC originals.
+#
+# The multipart upload is created when the batch is signed, so an upload
+# the client never completes or aborts (e.g. the tab is closed) keeps its
+# parts stored and billed. The bucket needs a lifecycle rule with
+# AbortIncompleteMultipartUpload (e.g. DaysAfterInitiation: 1) on uploads/.
+multipart_threshold = 64 * 1024 * 1024
+part_size = 16 * 1024 * 1024
+
+s3_client = metrics.instrument(boto3.client(
     's3',
     region_name='eu-west-2',
     config=Config(signature_version='s3v4')
-)
+))
 
 
-def lambda_handler(event, context):
-    filename = event['queryStringParameters']['filename']
-    image_key = 'uploads/{filename}'.format(
+def response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Access-Control-Allow-Headers': '*',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
+        },
+        'body': json.dumps(body)
+    }
+
+
+def upload_key(filename):
+    return 'uploads/{filename}'.format(
         filename = filename,
     )
-    url = s3_client.generate_presigned_url(
+
+
+def sign_upload(filename, content_type='image/jpeg'):
+    return s3_client.generate_presigned_url(
         ClientMethod='put_object',
         Params={
             'Bucket': bucket,
-            'Key': image_key,
-            'ContentType': 'image/jpeg',
+            'Key': upload_key(filename),
+            'ContentType': content_type,
         },
         ExpiresIn=600
     )
 
+
+def sign_multipart_upload(filename, size, content_type):
+    """
+    Start a multipart upload and return its id with a presigned URL
+    for each part
+    """
+    image_key = upload_key(filename)
+    upload = s3_client.create_multipart_upload(
+        Bucket=bucket,
+        Key=image_key,
+        ContentType=content_type,
+    )
+    part_urls = [
+        s3_client.generate_presigned_url(
+            ClientMethod='upload_part',
+            Params={
+                'Bucket': bucket,
+                'Key': image_key,
+                'UploadId': upload['UploadId'],
+                'PartNumber': part_number,
+            },
+            ExpiresIn=3600
+        )
+        for part_number in range(1, math.ceil(size / part_size) + 1)
+    ]
     return {
-        'statusCode': 200,
-        'headers': {
-            'Access-Control-Allow-Headers': '*',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
-        },
-        'body': json.dumps({'url': url})
+        'key': image_key,
+        'upload_id': upload['UploadId'],
+        'part_size': part_size,
+        'part_urls': part_urls,
     }
+
+
+def sign_batch(files):
+    uploads = []
+    for file in files:
+        filename = file['filename']
+        content_type = file.get('content_type') or 'image/jpeg'
+        size = int(file.get('size', 0))
+        if size > multipart_threshold:
+            upload = sign_multipart_upload(filename, size, content_type)
+        else:
+            upload = {
+                'key': upload_key(filename),
+                'url': sign_upload(filename, content_type),
+            }
+        uploads.append({'filename': filename, 'content_type': content_type, **upload})
+    return uploads
+
+
+@metrics.handler('photo_upload_access')
+def lambda_handler(event, context):
+    if event.get('httpMethod') == 'POST':
+        request = json.loads(event['body'] or '{}')
+        action = request.get('action', 'sign')
+        if action in ('complete', 'abort') and not request.get('key', '').startswith('uploads/'):
+            return response(400, {'error': 'Only uploads can be completed or aborted'})
+
+        # Multipart uploads are completed (or aborted) by the client once
+        # all parts are uploaded, parts are [{"PartNumber": n, "ETag": "..."}]
+        if action == 'complete':
+            s3_client.complete_multipart_upload(
+                Bucket=bucket,
+                Key=request['key'],
+                UploadId=request['upload_id'],
+                MultipartUpload={
+                    'Parts': [
+                        {'PartNumber': int(part['PartNumber']), 'ETag': part['ETag']}
+                        for part in request['parts']
+                    ]
+                },
+            )
+            return response(200, {'key': request['key']})
+        if action == 'abort':
+            s3_client.abort_multipart_upload(
+                Bucket=bucket,
+                Key=request['key'],
+                UploadId=request['upload_id'],
+            )
+            return response(200, {'key': request['key']})
+
+        # Sign uploads for a batch of {"filename", "size", "content_type"}
+        files = request.get('files', [])
+        if len(files) > max_batch_size:
+            return response(400, {
+                'error': f'A maximum of {max_batch_size} files can be signed'
+            })
+        return response(200, {'uploads': sign_batch(files)})
+
+    filename = event['queryStringParameters']['filename']
+    return response(200, {'url': sign_upload(filename)})
@@ -1,47 +1,186 @@
 import json
 import os
+import threading
+import traceback
 import uuid
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, time
 from urllib.parse import unquote_plus
 
 import boto3
-import psycopg2
 
-from PIL import Image, ImageOps
-from PIL.ExifTags import TAGS
+from botocore.client import Config
+from psycopg2.extras import execute_values
 
-s3_client = boto3.client(
+from photo_archive import db, exif, facets, hashing, metrics, renditions
+
+# Number of S3 records processed at once. Pillow releases the GIL while
+# decoding, resizing and encoding, so worker threads overlap image work with
+# S3 downloads/uploads. Set to suit the function's memory (and so vCPU) size,
+# each worker holds one decoded original in memory.
+concurrency = max(1, int(os.environ.get('PROCESSOR_CONCURRENCY', '4')))
+
+s3_client = metrics.instrument(boto3.client(
     's3',
-    region_name='eu-west-2'
-)
+    region_name='eu-west-2',
+    config=Config(max_pool_connections=max(10, concurrency * 2))
+))
+
+# The perceptual hash (for the near-duplicate report) is cheap to compute
+# from the already decoded original, set PERCEPTUAL_HASH=0 to skip it
+perceptual_hashes = os.environ.get('PERCEPTUAL_HASH', '1') == '1'
+
+class ContentHashes:
+    """
+    Finds uploads whose content has already been imported, either as an
+    existing image or by another record in the same batch. Lookups are made
+    from the worker threads on the shared connection, serialised by a lock
+    and rolled back straight away so the connection isn't left idle in a
+    transaction while images are processed.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.claimed = {}
+
+    def find(self, content_hash, image_id):
+        """
+        Return (id of the image with the same content, whether it's being
+        imported in this batch), or (None, False) after claiming the
+        content hash for image_id
+        """
+        with self.lock:
+            claimed = self.claimed.get(content_hash)
+            if claimed is not None and claimed[0] != image_id:
+                return claimed
+
+            with self.conn.cursor() as cur:
+                # A replayed upload keeps its image id, its own row isn't
+                # a duplicate of it
+                cur.execute(
+                    "select id from images where content_hash = %(hash)s and id <> %(id)s limit 1",
+                    {'hash': content_hash, 'id': image_id}
+                )
+                record = cur.fetchone()
+            self.conn.rollback()
+
+            if record is not None:
+                self.claimed[content_hash] = (record[0], False)
+                return record[0], False
+            self.claimed[content_hash] = (image_id, True)
+            return None, False
 
-image_longest_sides = {'thumbnail': 500, 'standard': 2000}
+def record_source(record):
+    """
+    Return the bucket, key and etag of the uploaded object an S3 record
+    refers to. The key and etag identify the upload so replayed events
+    can be matched to images already imported.
+    """
+    return (
+        record['s3']['bucket']['name'],
+        unquote_plus(record['s3']['object']['key']),
+        record['s3']['object'].get('eTag', ''),
+    )
+
+def process_record(record, image_id, camera_photographers, content_hashes):
+    """
+    Import a single uploaded image: extract exif data, copy the original into
+    place and upload its renditions. Returns the values to store in the db.
+    The upload itself is only removed once the db transaction has committed.
+    Uploads with the same content as an image that's already imported are
+    skipped before decoding and returned with duplicate_of set.
+    """
+    bucket, key, etag = record_source(record)
+    original, content_hash = hashing.download_with_hash(s3_client, bucket, key)
+
+    duplicate_of, in_batch = content_hashes.find(content_hash, image_id)
+    if duplicate_of is not None:
+        metrics.count('duplicates')
+        return {
+            'id': image_id,
+            'duplicate_of': duplicate_of,
+            'duplicate_in_batch': in_batch,
+            'bucket': bucket,
+            'source_key': key,
+            'source_etag': etag,
+        }
+
+    with renditions.open_original(original) as image:
+        exif_data = exif.decode(image.getexif())
+
+        # Cameras with an unset clock write dates like 0000:00:00 00:00:00,
+        # which are treated as missing rather than failing the batch insert
+        try:
+            date_time = datetime.strptime(exif_data['DateTime'], '%Y:%m:%d %H:%M:%S')
+            year = f'{date_time.year:04}'
+            month = f'{date_time.month:02}'
+            time_created = date_time.isoformat(' ')
+        except (KeyError, TypeError, ValueError):
+            metrics.count('no_date')
+            year = '1970'
+            month = '01'
+            time_created = '1970-01-01'
+
+        time_processed = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+
+        camera = None
+        photographer = None
+        try:
+            camera = exif_data['Make']
+            camera += f" {exif_data['Model']}"
+
+            try:
+                photographer = camera_photographers[camera]
+            except KeyError:
+                metrics.count('no_photographer')
 
-def resize(image, image_type):
-    new_longest_side = image_longest_sides[image_type]
+        except KeyError:
+            camera = None
+            metrics.count('no_camera')
 
-    if image.size[0] > image.size[1]:
-        width_longest = True
-        cur_longest_side = image.size[0]
-    else:
-        width_longest = False
-        cur_longest_side = image.size[1]
+        target_key = renditions.original_key(year, month, image_id)
+        s3_client.copy_object(
+            Bucket=bucket,
+            CopySource={
+                'Bucket': bucket,
+                'Key': key
+            },
+            Key=target_key
+        )
 
-    # If the current longest side is less than or equal to the new longest side
-    # then we don't need to do any resizing, return current size
-    if cur_longest_side <= new_longest_side:
-        new_size = image.size
-    else:
-        ratio = image.size[1] / image.size[0]
+        rendered, details = renditions.render_with_details(image)
+        renditions.upload_renditions(
+            s3_client,
+            bucket,
+            year,
+            month,
+            image_id,
+            rendered
+        )
 
-        if width_longest:
-            new_size = (new_longest_side, round(new_longest_side * ratio))
-        else:
-            new_size = (round(new_longest_side / ratio), new_longest_side)
+        # After rendering, which has already decoded the image
+        perceptual_hash = hashing.dhash(image) if perceptual_hashes else None
 
-    return ImageOps.exif_transpose(image.resize(new_size, Image.BICUBIC))
+    return {
+        'id': image_id,
+        'duplicate_of': None,
+        'time_created': time_created,
+        'time_processed': time_processed,
+        'camera': camera,
+        'photographer': photographer,
+        'bucket': bucket,
+        'source_key': key,
+        'source_etag': etag,
+        'content_hash': content_hash,
+        'perceptual_hash': perceptual_hash,
+        'width': details['width'],
+        'height': details['height'],
+        'placeholder': details['placeholder'],
+    }
 
+@metrics.handler('photo_upload_processor')
 def lambda_handler(event, context):
     # Validity check s3 records exist
     if 'Records' not in event:
@@ -54,126 +193,188 @@ def lambda_handler(event, context):
         print("DB_CONN environment variable not set")
         return
 
-    conn = psycopg2.connect(os.environ['DB_CONN'])
+    conn = db.get_connection()
 
-    # Get camera photographers
-    with conn.cursor() as cur:
-        cur.execute("select camera, photographer from camera_photographer")
-        records = cur.fetchall()
+    # The read transaction is ended before processing so the connection
+    # isn't left idle in a transaction while images are processed
+    with conn:
+        # Get camera photographers
+        with conn.cursor() as cur:
+            db.execute_prepared(cur, "select camera, photographer from camera_photographer")
+            records = cur.fetchall()
 
-    camera_photographers = {}
-    for record in records:
-        camera = record[0]
-        photographer = record[1]
-        camera_photographers[camera] = photographer
+        camera_photographers = {}
+        for record in records:
+            camera = record[0]
+            photographer = record[1]
+            camera_photographers[camera] = photographer
 
-    for record in s3_records:
-        bucket = record['s3']['bucket']['name']
-        print(bucket)
-        key = unquote_plus(record['s3']['object']['key'])
-        print(key)
-        image_id = str(uuid.uuid4())
-        tmp_path = '/tmp/{image_id}.jpg'.format(image_id=image_id)
-        s3_client.download_file(bucket, key, tmp_path)
+        # Reuse the ids of uploads that have already been imported (a replayed
+        # event) so they don't create duplicate images under new ids
+        sources = [record_source(record) for record in s3_records]
+        with conn.cursor() as cur:
+            db.execute_prepared(
+                cur,
+                "select source_key, source_etag, id from images where source_key = any(%(keys)s)",
+                {'keys': [key for _, key, _ in sources]}
+            )
+            existing_ids = {(record[0], record[1]): record[2] for record in cur.fetchall()}
 
-        with Image.open(tmp_path) as image:
-            exif_data = {}
-            for tag, value in image.getexif().items():
-                decoded = TAGS.get(tag, tag)
-                exif_data[decoded] = value
+    # Process records concurrently, a failure processing one record is logged
+    # and doesn't stop the rest of the batch. Uploads that fail are left in
+    # place in the uploads folder.
+    images = []
+    duplicates = []
+    failed_keys = []
+    content_hashes = ContentHashes(conn)
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(s3_records))) as executor:
+        futures = []
+        seen_sources = set()
+        for record, (_, key, etag) in zip(s3_records, sources):
+            # The same upload can appear more than once in a batch
+            if (key, etag) in seen_sources:
+                continue
+            seen_sources.add((key, etag))
 
-            print(exif_data)
+            image_id = existing_ids.get((key, etag)) or str(uuid.uuid4())
+            futures.append(
+                (key, executor.submit(process_record, record, image_id, camera_photographers, content_hashes))
+            )
 
+        for key, future in futures:
             try:
-                date_time = exif_data['DateTime']
-                year = date_time[:4]
-                month = date_time[5:7]
-                time_created = year + '-' + month + '-' + date_time[8:]
-            except KeyError:
-                print('no DateTime')
-                year = '1970'
-                month = '01'
-                time_created = '1970-01-01'
+                image = future.result()
+            except Exception:
+                print(f"Failed to process {key}")
+                traceback.print_exc()
+                failed_keys.append(key)
+                continue
+            if image['duplicate_of'] is None:
+                images.append(image)
+            else:
+                duplicates.append(image)
 
-            time_processed = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    # A duplicate of another upload in the batch is only dropped if that
+    # upload was imported, otherwise it's left in place to be retried
+    imported_ids = {image['id'] for image in images}
+    for duplicate in list(duplicates):
+        if duplicate['duplicate_in_batch'] and duplicate['duplicate_of'] not in imported_ids:
+            duplicates.remove(duplicate)
+            failed_keys.append(duplicate['source_key'])
 
-            with conn.cursor() as cur:
-                cur.execute(
-                    "insert into images (id, time_created, time_processed) values (%(id)s, %(time_created)s, %(time_processed)s)",
-                    {
-                        'id': image_id,
-                        'time_created':  time_created,
-                        'time_processed':  time_processed,
-                    },
-                )
+    # Write rows for the whole batch in one transaction
+    image_rows = [
+        (
+            image['id'],
+            image['time_created'],
+            image['time_processed'],
+            image['source_key'],
+            image['source_etag'],
+            image['content_hash'],
+            image['perceptual_hash'],
+            image['width'],
+            image['height'],
+            image['placeholder'],
+        )
+        for image in images
+    ]
+    replayed_ids = [
+        image['id']
+        for image in images
+        if (image['source_key'], image['source_etag']) in existing_ids
+    ]
 
-            try:
-                camera = exif_data['Make']
-                camera += f" {exif_data['Model']}"
-
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "insert into image_metadata (image_id, type, value) values (%(id)s, 'camera', %(camera)s)",
-                        {
-                            'id': image_id,
-                            'camera': camera,
-                        }
+    # Processing can take a while, get the connection again so it's
+    # health checked before use
+    conn = db.get_connection()
+    raced = []
+    with conn:
+        with conn.cursor() as cur:
+            # Replayed images were counted when first imported, their old
+            # photographer and month are uncounted before they're replaced
+            facets.remove_images_pg(cur, replayed_ids)
+            stored_ids = {}
+            if len(image_rows) > 0:
+                stored_ids = {
+                    (source_key, source_etag): image_id
+                    for image_id, source_key, source_etag in execute_values(
+                        cur,
+                        "insert into images (id, time_created, time_processed, source_key, source_etag, "
+                        "content_hash, perceptual_hash, width, height, placeholder) values %s "
+                        "on conflict (source_key, source_etag) do update "
+                        "set time_created = excluded.time_created, time_processed = excluded.time_processed, "
+                        "content_hash = excluded.content_hash, perceptual_hash = excluded.perceptual_hash, "
+                        "width = excluded.width, height = excluded.height, placeholder = excluded.placeholder "
+                        "returning id, source_key, source_etag",
+                        image_rows,
+                        fetch=True
                     )
+                }
 
-                try:
-                    photographer = camera_photographers[camera]
-                    print(photographer)
-
-                    with conn.cursor() as cur:
-                        cur.execute(
-                            "insert into image_metadata (image_id, type, value) values (%(id)s, 'photographer', %(photographer)s)",
-                            {
-                                'id': image_id,
-                                'photographer': photographer,
-                            }
-                        )
+            # An upload imported concurrently by another invocation (S3
+            # events are delivered at least once) keeps that invocation's
+            # id, its metadata is replaced and it was already counted
+            for image in images:
+                stored_id = stored_ids[(image['source_key'], image['source_etag'])]
+                if stored_id != image['id']:
+                    raced.append(dict(image))
+                    image['id'] = stored_id
 
-                except KeyError:
-                    print("No photographer for camera")
+            raced_ids = [stored_ids[(image['source_key'], image['source_etag'])] for image in raced]
+            if len(replayed_ids + raced_ids) > 0:
+                cur.execute(
+                    "delete from image_metadata where image_id = any(%(ids)s) and type in ('camera', 'photographer')",
+                    {'ids': replayed_ids + raced_ids}
+                )
 
-            except KeyError:
-                print("No camera data")
+            metadata_rows = []
+            facet_deltas = Counter()
+            for image in images:
+                if image['camera'] is not None:
+                    metadata_rows.append((image['id'], 'camera', image['camera']))
+                if image['photographer'] is not None:
+                    metadata_rows.append((image['id'], 'photographer', image['photographer']))
+                if image['id'] not in raced_ids:
+                    facet_deltas.update(facets.image_deltas(
+                        photographer=image['photographer'],
+                        time_created=image['time_created']
+                    ))
+            if len(metadata_rows) > 0:
+                execute_values(
+                    cur,
+                    "insert into image_metadata (image_id, type, value) values %s",
+                    metadata_rows
+                )
+            facets.apply_pg(cur, facet_deltas)
 
-            target_key = 'originals/{year}/{month}/{id}.jpg'.format(
-                year = year,
-                month = month,
-                id = image_id
-            )
-            s3_client.copy_object(
-                Bucket=bucket,
-                CopySource={
-                    'Bucket': bucket,
-                    'Key': key
-                },
-                Key=target_key
-            )
-            s3_client.delete_object(
+    # Remove the imported and duplicate uploads, and the objects written
+    # under the unused ids of concurrently imported ones, batched per
+    # bucket (up to 1000 keys per request)
+    uploads = {}
+    for image in images + duplicates:
+        uploads.setdefault(image['bucket'], []).append(image['source_key'])
+    for image in raced:
+        year = image['time_created'][:4]
+        month = image['time_created'][5:7]
+        uploads[image['bucket']].append(renditions.original_key(year, month, image['id']))
+        uploads[image['bucket']] += [
+            renditions.rendition_key(image_type, year, month, image['id'])
+            for image_type in renditions.rendition_specs
+        ]
+    for bucket, keys in uploads.items():
+        for i in range(0, len(keys), 1000):
+            s3_client.delete_objects(
                 Bucket=bucket,
-                Key=key,
+                Delete={
+                    'Objects': [{'Key': key} for key in keys[i:i + 1000]],
+                    'Quiet': True,
+                }
             )
 
-            for image_type in ['thumbnail', 'standard']:
-                target_path = '/tmp/resized_{id}.jpg'.format(id=image_id)
-                new_image = resize(image, image_type)
-                new_image.save(target_path)
-                folder = 'thumbnails' if image_type == 'thumbnail' else 'standard'
-                target_key = '{folder}/{year}/{month}/{id}.jpg'.format(
-                    folder = folder,
-                    year = year,
-                    month = month,
-                    id = image_id
-                )
-                s3_client.upload_file(
-                    target_path,
-                    bucket,
-                    target_key,
-                    ExtraArgs={'ContentType': 'image/jpeg'}
-                )
-
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    metrics.count('processed', len(images))
+    metrics.count('failed', len(failed_keys))
+    return {
+        'processed': len(images),
+        'duplicates': {duplicate['source_key']: duplicate['duplicate_of'] for duplicate in duplicates},
+        'failed': failed_keys,
+    }
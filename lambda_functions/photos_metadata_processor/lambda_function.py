@@ -1,67 +1,43 @@
-from datetime import datetime, time
 from urllib.parse import unquote_plus
 import boto3
 import botocore
+import io
 import json
 import os
+import traceback
 import uuid
-from PIL import Image, ImageOps
-from PIL.ExifTags import TAGS
+from collections import Counter
 
-rds_client = boto3.client('rds-data')
-s3_client = boto3.client(
+from photo_archive import backends, exif, facets, metrics, renditions
+
+rds_client = metrics.instrument(boto3.client('rds-data'))
+s3_client = metrics.instrument(boto3.client(
     's3',
     region_name='eu-west-2'
-)
+))
 events_client = boto3.client('events')
-lambda_client = boto3.client('lambda')
+lambda_client = metrics.instrument(boto3.client('lambda'))
 
 bucket = 'peteandrew-photoarchive-eu'
 cluster_arn = 'arn:aws:rds:eu-west-2:306578912108:cluster:database-1'
 secret_arn = 'arn:aws:secretsmanager:eu-west-2:306578912108:secret:rds-db-credentials/cluster-QBRFG6NNVJEGKYGGMCDHRUGXVA/admin-F2AjV8' 
 database = 'photoarchive'
-image_longest_sides = {'thumbnail': 500, 'standard': 2000}
 
-def add_retry_rule(context):
-    """
-    Create a Cloudwatch rule to retry this function
-    after 1 minute
-    """
-    now = datetime.now()
-    rule_name = 'retry-{timestamp}'.format(
-        timestamp=now.strftime("%s")
-    )
-    response = events_client.put_rule(
-        Name=rule_name,
-        ScheduleExpression='rate(1 minute)',
-        State='ENABLED',
-    )
-    rule_arn = response['RuleArn']
-    events_client.put_targets(
-        Rule=rule_name,
-        Targets=[
-            {
-                'Id': 'photos_metadata_processor',
-                'Arn': 'arn:aws:lambda:eu-west-2:306578912108:function:photos_metadata_processor',
-                'Input': json.dumps({
-                    'rule': rule_name,
-                })
-            }
-        ]
-    )
-    lambda_client.add_permission(
-        FunctionName=context.invoked_function_arn,
-        StatementId=rule_name,
-        Action='lambda:InvokeFunction',
-        Principal='events.amazonaws.com',
-        SourceArn=rule_arn,
-    )
-    print("Retry rule added: {rule_name}".format(rule_name=rule_name))
+# Images are claimed from image_process_queue in chunks by setting a lease,
+# so several invocations can drain the queue in parallel. A lease that
+# expires (the invocation failed or timed out) makes the image available
+# again, up to max_attempts times.
+chunk_size = int(os.environ.get('CHUNK_SIZE', '30'))
+lease_seconds = int(os.environ.get('LEASE_SECONDS', '600'))
+max_attempts = 5
+# Time left for saving, logging and continuing after the last chunk
+reserve_millis = 20000
 
 def remove_retry_rule(context, rule):
     """
     Remove existing Cloudwatch event rule this function
-    was called from
+    was called from. Retry rules are no longer created but
+    any left from earlier runs are cleaned up.
     """
     response = events_client.list_targets_by_rule(
         Rule=rule
@@ -80,220 +56,197 @@ def remove_retry_rule(context, rule):
     )
     print("Retry rule removed: {rule}".format(rule=rule))
 
-def resize(image, image_type):
-    new_longest_side = image_longest_sides[image_type]
-
-    if image.size[0] > image.size[1]:
-        width_longest = True
-        cur_longest_side = image.size[0]
-    else:
-        width_longest = False
-        cur_longest_side = image.size[1]
+def image_metadata(image_id, exif_data, camera_photographers):
+    metadata = []
+    try:
+        camera = exif_data['Make']
+        camera += f" {exif_data['Model']}"
+        metadata.append({'id': image_id, 'type': 'camera', 'value': camera})
 
-    # If the current longest side is less than or equal to the new longest side
-    # then we don't need to do any resizing, return current size
-    if cur_longest_side <= new_longest_side:
-        new_size = image.size
-    else:
-        ratio = image.size[1] / image.size[0]
+        try:
+            photographer = camera_photographers[camera]
+            metadata.append({'id': image_id, 'type': 'photographer', 'value': photographer})
+        except KeyError:
+            metrics.count('no_photographer')
 
-        if width_longest:
-            new_size = (new_longest_side, round(new_longest_side * ratio))
-        else:
-            new_size = (round(new_longest_side / ratio), new_longest_side)
+    except KeyError:
+        metrics.count('no_camera')
 
-    return ImageOps.exif_transpose(image.resize(new_size, Image.BICUBIC))
+    return metadata
 
-def lambda_handler(event, context):
-    # Check if RDS DB is available (running)
-    # Will raise an exception if not
-    rds_client.execute_statement(
-        resourceArn = cluster_arn, 
-        secretArn = secret_arn, 
-        database = database, 
-        sql = 'select count(1) from images'
-    )
+def process_image(image_id, date_created, camera_photographers, with_renditions):
+    """
+    Extract exif data from an image's original, and regenerate its
+    renditions if requested. Returns the metadata rows to store for the
+    image and, with renditions, its dimensions and placeholder (otherwise
+    None). Without renditions only the start of the original containing
+    the exif data is downloaded.
+    """
+    year = date_created[:4]
+    month = date_created[5:7]
+    key = renditions.original_key(year, month, image_id)
+
+    if not with_renditions:
+        exif_data = exif.read_exif(s3_client, bucket, key)
+        return image_metadata(image_id, exif_data, camera_photographers), None
+
+    original = io.BytesIO()
+    with metrics.stage('download'):
+        s3_client.download_fileobj(bucket, key, original)
+    original.seek(0)
+
+    with renditions.open_original(original) as image:
+        exif_data = exif.decode(image.getexif())
+
+        rendered, details = renditions.render_with_details(image)
+        renditions.upload_renditions(
+            s3_client,
+            bucket,
+            year,
+            month,
+            image_id,
+            rendered
+        )
 
-    if 'rule' in event:
-        remove_retry_rule(context, event['rule'])
+    return image_metadata(image_id, exif_data, camera_photographers), dict(details, id=image_id)
 
-    # Get camera photographers
-    response = rds_client.execute_statement(
-        resourceArn = cluster_arn, 
-        secretArn = secret_arn, 
-        database = database, 
-        sql = "select camera, photographer from camera_photographer"
+def save_metadata(backend, image_ids, metadata, details=()):
+    """
+    Replace the metadata of the processed images, update the dimensions
+    and placeholders of those with regenerated renditions and remove them
+    from the queue in one transaction, each statement batched for all images
+    """
+    id_params = [{'id': image_id} for image_id in image_ids]
+    photographer_deltas = Counter(
+        (facets.PHOTOGRAPHER, row['value'])
+        for row in metadata
+        if row['type'] == 'photographer'
     )
-    camera_photographers = {}
-    for record in response['records']:
-        camera = record[0]['stringValue']
-        photographer = record[1]['stringValue']
-        camera_photographers[camera] = photographer
+    with backend.transaction() as tx:
+        # Photographer facet counts move from the old photographer
+        # to the new one
+        tx.execute_batch(facets.remove_photographer_sql, id_params)
+        tx.execute_batch('delete from image_metadata where image_id = :id', id_params)
+        tx.execute_batch(
+            'insert into image_metadata (image_id, type, value) values (:id, :type, :value)',
+            metadata
+        )
+        facets.apply(tx, photographer_deltas)
+        tx.execute_batch(
+            'update images set width = :width, height = :height, placeholder = :placeholder where id = :id',
+            list(details)
+        )
+        tx.execute_batch('delete from image_process_queue where image_id = :id', id_params)
 
-    # Get 100 rows from image_process_queue
+def claim_images(backend):
+    """
+    Lease the next chunk of images in the queue to this invocation,
+    skipping rows locked by another worker's claim
+    """
     sql = (
-        "select ipq.image_id, i.time_created "
-        "from image_process_queue ipq "
-        "join images i on i.id = ipq.image_id "
-        "limit 30"
-    )
-    response = rds_client.execute_statement(
-        resourceArn = cluster_arn, 
-        secretArn = secret_arn, 
-        database = database, 
-        sql = sql
+        "update image_process_queue ipq "
+        "set lease_expires = now() + make_interval(secs => :lease_seconds), attempts = ipq.attempts + 1 "
+        "from images i "
+        "where i.id = ipq.image_id "
+        "and ipq.image_id in ("
+        "select image_id from image_process_queue "
+        "where (lease_expires is null or lease_expires < now()) "
+        "and attempts < :max_attempts "
+        "order by image_id "
+        "limit :limit "
+        "for update skip locked"
+        ") "
+        "returning ipq.image_id, i.time_created"
     )
-    for record in response['records']:
-        image_id = record[0]['stringValue']
-        date_created = record[1]['stringValue']
-
-        year = date_created[:4]
-        month = date_created[5:7]
-        key = 'originals/{year}/{month}/{id}.jpg'.format(
-            year = year,
-            month = month,
-            id = image_id
-        )
-        print(key)
-
-        # Get original image file and extract exif data and insert metadata records
-        source_path = '/tmp/original_{id}.jpg'.format(id=id)
-        s3_client.download_file(bucket, key, source_path)
-
-        with Image.open(source_path) as image:
-            exif_data = {}
-            for tag, value in image.getexif().items():
-                decoded = TAGS.get(tag, tag)
-                exif_data[decoded] = value
-
-            print(exif_data)            
-
-            rds_client.execute_statement(
-                resourceArn = cluster_arn,
-                secretArn = secret_arn,
-                database = database,
-                sql = 'delete from image_metadata where image_id = :id',
-                parameters = [
-                    {
-                        'name': 'id',
-                        'value': {'stringValue': image_id}
-                    },
-                ]
+    return backend.query(sql, {
+        'lease_seconds': lease_seconds,
+        'max_attempts': max_attempts,
+        'limit': chunk_size,
+    })
+
+def process_chunk(backend, images, camera_photographers, with_renditions):
+    image_ids = []
+    metadata = []
+    details = []
+    for image_id, date_created in images:
+        # An image that fails is logged and left in the queue, it's
+        # retried once its lease expires
+        try:
+            image_metadata_rows, image_details = process_image(
+                image_id, str(date_created), camera_photographers, with_renditions
             )
+        except Exception:
+            print(f"Failed to process {image_id}")
+            traceback.print_exc()
+            continue
+        image_ids.append(image_id)
+        metadata += image_metadata_rows
+        if image_details is not None:
+            details.append(image_details)
+
+    if len(image_ids) > 0:
+        save_metadata(backend, image_ids, metadata, details)
+    return len(image_ids)
+
+def invoke_worker(context, payload):
+    lambda_client.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(payload),
+    )
 
-            try:
-                camera = exif_data['Make']
-                camera += f" {exif_data['Model']}"
-                print(camera)
-
-                rds_client.execute_statement(
-                    resourceArn = cluster_arn,
-                    secretArn = secret_arn,
-                    database = database,
-                    sql = 'insert into image_metadata (image_id, type, value) values (:id, "camera", :camera)',
-                    parameters = [
-                        {
-                            'name': 'id',
-                            'value': {'stringValue': image_id}
-                        },
-                        {
-                            'name': 'camera',
-                            'value': {'stringValue': camera}
-                        },
-                    ]
-                )
-
-                try:
-                    photographer = camera_photographers[camera]
-                    print(photographer)
-                    rds_client.execute_statement(
-                        resourceArn = cluster_arn,
-                        secretArn = secret_arn,
-                        database = database,
-                        sql = 'insert into image_metadata (image_id, type, value) values (:id, "photographer", :photographer)',
-                        parameters = [
-                            {
-                                'name': 'id',
-                                'value': {'stringValue': image_id}
-                            },
-                            {
-                                'name': 'photographer',
-                                'value': {'stringValue': photographer}
-                            },
-                        ]
-                    )
-
-                except KeyError:
-                    print("No photographer for camera")
-
-            except KeyError:
-                print("No camera data")
-
-            for image_type in ['thumbnail', 'standard']:
-                target_path = '/tmp/resized_{id}.jpg'.format(id=image_id)
-                new_image = resize(image, image_type)
-                new_image.save(target_path)
-                folder = 'thumbnails' if image_type == 'thumbnail' else 'standard'
-                target_key = '{folder}/{year}/{month}/{id}.jpg'.format(
-                    folder = folder,
-                    year = year,
-                    month = month,
-                    id = image_id
-                )
-                s3_client.upload_file(
-                    target_path,
-                    bucket,
-                    target_key,
-                    ExtraArgs={'ContentType': 'image/jpeg'}
-                )
-                os.remove(target_path)
-
-            # Check whether thumbnail exists and if not, generate one
-            # thumbnail_key = 'thumbnails/{year}/{month}/{id}.jpg'.format(
-            #     year = year,
-            #     month = month,
-            #     id = image_id
-            # )
-            # try:
-            #     s3_client.head_object(Bucket=bucket, Key=thumbnail_key)
-            # except botocore.exceptions.ClientError as e:
-            #     target_path = '/tmp/resized_{id}.jpg'.format(id=id)
-            #     new_image = resize(image, 'thumbnail')
-            #     new_image.save(target_path)
-
-            #     s3_client.upload_file(
-            #         target_path,
-            #         bucket,
-            #         thumbnail_key,
-            #         ExtraArgs={'ContentType': 'image/jpeg'}
-            #     )
-
-            #     os.remove(target_path)
-
-        os.remove(source_path)
+@metrics.handler('photos_metadata_processor')
+def lambda_handler(event, context):
+    backend = backends.get_backend(rds_client, cluster_arn, secret_arn, database)
 
-        rds_client.execute_statement(
-            resourceArn = cluster_arn, 
-            secretArn = secret_arn, 
-            database = database, 
-            sql = "delete from image_process_queue where image_id = :image_id",
-            parameters = [
-                {
-                    'name': 'image_id',
-                    'value': {'stringValue': image_id}
-                }
-            ]
-        )
+    # Get camera photographers, this also checks the RDS DB is
+    # available (running), will raise an exception if not
+    camera_photographers = {}
+    for camera, photographer in backend.query("select camera, photographer from camera_photographer"):
+        camera_photographers[camera] = photographer
 
-    # Get count of photos remaining to be processed
-    response = rds_client.execute_statement(
-        resourceArn = cluster_arn, 
-        secretArn = secret_arn, 
-        database = database, 
-        sql = "select count(1) from image_process_queue"
-    )
-    remaining_images = response['records'][0][0]['longValue']
-    print(f'Images remaining: {remaining_images}')
+    if 'rule' in event:
+        remove_retry_rule(context, event['rule'])
 
-    if remaining_images > 0:
-        add_retry_rule(context)
\ No newline at end of file
+    # By default only metadata is refreshed, pass {"renditions": true}
+    # to regenerate renditions too
+    with_renditions = bool(event.get('renditions', False))
+    worker_event = {'renditions': with_renditions}
+
+    # Start additional workers to drain the queue in parallel, e.g. {"workers": 4}
+    workers = int(event.get('workers', 1))
+    for _ in range(workers - 1):
+        invoke_worker(context, worker_event)
+
+    # Keep claiming and processing chunks while there is time left for
+    # another chunk, based on the slowest chunk so far
+    # With a timeout too short for the full reserve, a quarter of the time
+    # is kept in reserve instead so the first chunk is still claimed
+    reserve = min(reserve_millis, context.get_remaining_time_in_millis() // 4)
+    processed = 0
+    chunks = 0
+    slowest_chunk_millis = 0
+    drained = False
+    while True:
+        remaining_millis = context.get_remaining_time_in_millis()
+        if remaining_millis - reserve < slowest_chunk_millis:
+            break
+
+        images = claim_images(backend)
+        if len(images) == 0:
+            drained = True
+            break
+        chunks += 1
+
+        processed += process_chunk(backend, images, camera_photographers, with_renditions)
+        chunk_millis = remaining_millis - context.get_remaining_time_in_millis()
+        slowest_chunk_millis = max(slowest_chunk_millis, chunk_millis)
+
+    print(f'Images processed: {processed}')
+    metrics.count('processed', processed)
+
+    # Out of time with images still available, continue in a new invocation.
+    # Only after claiming a chunk, so an invocation that can't make progress
+    # doesn't start an endless chain of invocations.
+    if not drained and chunks > 0:
+        invoke_worker(context, worker_event)
@@ -0,0 +1,182 @@
+"""
+Statement execution for functions that use the RDS Data API, with a plain
+Postgres (psycopg2) equivalent so the same code can run against a local
+database.
+
+SQL uses Data API style :name parameters and params are dicts of python
+values. query() returns rows as tuples of python values.
+"""
+import os
+import re
+
+from contextlib import contextmanager
+
+data_api_param = re.compile(r'(?<!:):(\w+)')
+
+
+def field(value):
+    if value is None:
+        return {'isNull': True}
+    if isinstance(value, bool):
+        return {'booleanValue': value}
+    if isinstance(value, int):
+        return {'longValue': value}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def field_value(field):
+    if field.get('isNull'):
+        return None
+    for value in field.values():
+        return value
+
+
+def data_api_parameters(params):
+    return [
+        {'name': name, 'value': field(value)}
+        for name, value in (params or {}).items()
+    ]
+
+
+class DataApiBackend:
+    def __init__(self, rds_client, cluster_arn, secret_arn, database, transaction_id=None):
+        self.rds_client = rds_client
+        self.cluster_arn = cluster_arn
+        self.secret_arn = secret_arn
+        self.database = database
+        self.transaction_id = transaction_id
+
+    def request_args(self):
+        args = {
+            'resourceArn': self.cluster_arn,
+            'secretArn': self.secret_arn,
+            'database': self.database,
+        }
+        if self.transaction_id is not None:
+            args['transactionId'] = self.transaction_id
+        return args
+
+    def query(self, sql, params=None):
+        response = self.rds_client.execute_statement(
+            sql = sql,
+            parameters = data_api_parameters(params),
+            **self.request_args()
+        )
+        return [
+            tuple(field_value(field) for field in record)
+            for record in response.get('records', [])
+        ]
+
+    def execute(self, sql, params=None):
+        response = self.rds_client.execute_statement(
+            sql = sql,
+            parameters = data_api_parameters(params),
+            **self.request_args()
+        )
+        return response.get('numberOfRecordsUpdated', 0)
+
+    def execute_batch(self, sql, param_sets):
+        """
+        Run sql once for each dict of params in a single request
+        """
+        if len(param_sets) == 0:
+            return
+        self.rds_client.batch_execute_statement(
+            sql = sql,
+            parameterSets = [data_api_parameters(params) for params in param_sets],
+            **self.request_args()
+        )
+
+    @contextmanager
+    def transaction(self):
+        """
+        Yield a backend whose statements all run in one transaction,
+        committed on exit or rolled back if an exception is raised
+        """
+        response = self.rds_client.begin_transaction(
+            resourceArn = self.cluster_arn,
+            secretArn = self.secret_arn,
+            database = self.database,
+        )
+        transaction_id = response['transactionId']
+        try:
+            yield DataApiBackend(
+                self.rds_client,
+                self.cluster_arn,
+                self.secret_arn,
+                self.database,
+                transaction_id
+            )
+        except Exception:
+            self.rds_client.rollback_transaction(
+                resourceArn = self.cluster_arn,
+                secretArn = self.secret_arn,
+                transactionId = transaction_id,
+            )
+            raise
+        self.rds_client.commit_transaction(
+            resourceArn = self.cluster_arn,
+            secretArn = self.secret_arn,
+            transactionId = transaction_id,
+        )
+
+
+class PostgresBackend:
+    def __init__(self, conn, in_transaction=False):
+        self.conn = conn
+        self.in_transaction = in_transaction
+
+    @staticmethod
+    def pyformat(sql):
+        return data_api_param.sub(r'%(\1)s', sql.replace('%', '%%'))
+
+    @contextmanager
+    def cursor(self):
+        # Outside a transaction each statement commits, as it does
+        # with the Data API
+        if self.in_transaction:
+            with self.conn.cursor() as cur:
+                yield cur
+        else:
+            with self.conn:
+                with self.conn.cursor() as cur:
+                    yield cur
+
+    def query(self, sql, params=None):
+        with self.cursor() as cur:
+            cur.execute(self.pyformat(sql), params or {})
+            if cur.description is None:
+                return []
+            return [tuple(record) for record in cur.fetchall()]
+
+    def execute(self, sql, params=None):
+        with self.cursor() as cur:
+            cur.execute(self.pyformat(sql), params or {})
+            return cur.rowcount
+
+    def execute_batch(self, sql, param_sets):
+        from psycopg2.extras import execute_batch
+
+        if len(param_sets) == 0:
+            return
+        with self.cursor() as cur:
+            execute_batch(cur, self.pyformat(sql), param_sets)
+
+    @contextmanager
+    def transaction(self):
+        with self.conn:
+            yield PostgresBackend(self.conn, in_transaction=True)
+
+
+def get_backend(rds_client, cluster_arn, secret_arn, database):
+    """
+    Return the Data API backend, or a Postgres backend using DB_CONN
+    when DB_BACKEND=postgres
+    """
+    if os.environ.get('DB_BACKEND') == 'postgres':
+        from photo_archive import db
+
+        return PostgresBackend(db.get_connection())
+    return DataApiBackend(rds_client, cluster_arn, secret_arn, database)
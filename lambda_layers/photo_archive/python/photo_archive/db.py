@@ -0,0 +1,114 @@
+import hashlib
+import os
+import re
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+from photo_archive import metrics
+
+# A connection that has been idle for longer than this is checked with a
+# round trip before it's reused, connections can be dropped by the server
+# (or a proxy) while the function is frozen between invocations
+HEALTH_CHECK_SECONDS = 30
+
+named_param = re.compile(r'%\((\w+)\)s')
+
+connection = None
+last_used = 0
+prepared_statements = set()
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """
+    Cursor recording the time of each statement in the 'db' metrics stage
+    (execute_values and execute_batch run through execute too)
+    """
+    def execute(self, query, vars=None):
+        with metrics.stage('db'):
+            return super().execute(query, vars)
+
+
+def connect():
+    global connection, prepared_statements
+    with metrics.stage('db.connect'):
+        connection = psycopg2.connect(os.environ['DB_CONN'], cursor_factory=TimedCursor)
+    prepared_statements = set()
+    return connection
+
+
+def close():
+    global connection
+    if connection is not None and not connection.closed:
+        connection.close()
+    connection = None
+
+
+def healthy(conn):
+    try:
+        # Discard anything left open by a previous invocation that failed
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute('select 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def get_connection():
+    """
+    Return the connection kept open across warm invocations of the function,
+    reconnecting if it has been closed or fails a health check. Use it as
+    "with conn:" to commit or roll back, it shouldn't be closed.
+    """
+    global last_used
+
+    conn = connection
+    if conn is None or conn.closed:
+        conn = connect()
+    elif time.monotonic() - last_used > HEALTH_CHECK_SECONDS and not healthy(conn):
+        close()
+        conn = connect()
+
+    last_used = time.monotonic()
+    return conn
+
+
+def execute_prepared(cur, sql, params=None):
+    """
+    Execute sql (using %(name)s parameters) as a server-side prepared
+    statement, preparing it the first time it's seen on this connection.
+    The statement name is derived from the sql so queries built from the
+    same filters share a plan.
+    """
+    params = params or {}
+    names = []
+
+    def placeholder(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return '${num}'.format(num=names.index(match.group(1)) + 1)
+
+    statement_sql = named_param.sub(placeholder, sql)
+    statement_name = 'stmt_' + hashlib.md5(statement_sql.encode()).hexdigest()[:16]
+
+    if statement_name not in prepared_statements:
+        cur.execute('prepare {name} as {sql}'.format(
+            name = statement_name,
+            sql = statement_sql.replace('%%', '%')
+        ))
+        prepared_statements.add(statement_name)
+
+    if len(names) == 0:
+        cur.execute('execute {name}'.format(name=statement_name))
+    else:
+        cur.execute(
+            'execute {name} ({placeholders})'.format(
+                name = statement_name,
+                placeholders = ', '.join('%({param})s'.format(param=name) for name in names)
+            ),
+            params
+        )
@@ -0,0 +1,100 @@
+"""
+Read EXIF data from the APP1 segment at the start of a JPEG without
+downloading or decoding the rest of the image.
+"""
+from PIL import Image
+from PIL.ExifTags import TAGS
+
+from photo_archive import metrics
+
+# EXIF data is normally within the first few KB, a single ranged request
+# of this size almost always covers it
+header_bytes = 64 * 1024
+
+# Markers with no length field
+standalone_markers = {0x01, 0xD8} | set(range(0xD0, 0xD8))
+
+
+def decode(exif):
+    """
+    Return a dict of tag name to value for a PIL Exif object
+    """
+    exif_data = {}
+    for tag, value in exif.items():
+        decoded = TAGS.get(tag, tag)
+        exif_data[decoded] = value
+    return exif_data
+
+
+def exif_segment(data, read_more):
+    """
+    Return the EXIF APP1 segment payload (starting with 'Exif') from the
+    start of a JPEG, or None if there isn't one. data holds the leading
+    bytes of the file and read_more(start, end) returns further bytes
+    when a segment extends beyond them.
+    """
+    def ensure(end):
+        nonlocal data
+        if end > len(data):
+            data += read_more(len(data), max(end, len(data) + header_bytes))
+        if end > len(data):
+            raise ValueError('Unexpected end of JPEG data')
+
+    ensure(2)
+    if data[:2] != b'\xff\xd8':
+        raise ValueError('Not a JPEG')
+
+    pos = 2
+    while True:
+        ensure(pos + 2)
+        if data[pos] != 0xFF:
+            raise ValueError('Invalid JPEG marker')
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+        if marker in standalone_markers:
+            pos += 2
+            continue
+        # Start of scan or end of image, there are no more metadata segments
+        if marker in (0xDA, 0xD9):
+            return None
+
+        ensure(pos + 4)
+        length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        if marker == 0xE1:
+            ensure(pos + 2 + length)
+            segment = data[pos + 4:pos + 2 + length]
+            if segment.startswith(b'Exif\x00\x00'):
+                return segment
+        pos += 2 + length
+
+
+def read_exif(s3_client, bucket, key):
+    """
+    Return the decoded EXIF data of a JPEG in S3 using ranged GETs
+    for just the leading bytes of the object
+    """
+    def read_range(start, end):
+        with metrics.stage('download'):
+            try:
+                response = s3_client.get_object(
+                    Bucket=bucket,
+                    Key=key,
+                    Range='bytes={start}-{end}'.format(start=start, end=end - 1)
+                )
+            except s3_client.exceptions.ClientError as e:
+                # Requested range starts beyond the end of the object
+                if e.response['Error']['Code'] == 'InvalidRange':
+                    return b''
+                raise
+            return response['Body'].read()
+
+    segment = exif_segment(read_range(0, header_bytes), read_range)
+    if segment is None:
+        return {}
+
+    exif = Image.Exif()
+    exif.load(segment)
+    return decode(exif)
@@ -0,0 +1,132 @@
+"""
+Image counts per tag, photographer and month in facet_counts, kept up to
+date incrementally by the functions that change tags, metadata and images.
+The counts are populated for an existing archive, and corrected if they
+ever drift, by tools/rebuild_facets.py. Searches only use them to order
+filters, so a missing or stale count never changes results.
+
+Changes are collected as a Counter of (facet, value) to a +/- delta and
+applied with one batched upsert.
+"""
+from collections import Counter
+
+TAG = 'tag'
+PHOTOGRAPHER = 'photographer'
+MONTH = 'month'
+
+upsert_sql = (
+    "insert into facet_counts (facet, value, image_count) values (:facet, :value, :delta) "
+    "on conflict (facet, value) do update "
+    "set image_count = facet_counts.image_count + excluded.image_count"
+)
+
+# Decrement the photographer count for an image's current photographer,
+# run before its metadata is replaced
+remove_photographer_sql = (
+    "update facet_counts set image_count = image_count - 1 "
+    "where facet = 'photographer' and value in ("
+    "select value from image_metadata where image_id = :id and type = 'photographer'"
+    ")"
+)
+
+# Recreate all counts from the image tables, for the initial population.
+# The lock makes functions updating counts wait for the rebuild to commit,
+# their deltas then apply on top of counts that don't include their rows.
+rebuild_sql = [
+    "lock table facet_counts in exclusive mode",
+    "delete from facet_counts",
+    "insert into facet_counts (facet, value, image_count) "
+    "select 'tag', tag, count(*) from image_tag group by tag",
+    "insert into facet_counts (facet, value, image_count) "
+    "select 'photographer', value, count(distinct image_id) from image_metadata "
+    "where type = 'photographer' group by value",
+    "insert into facet_counts (facet, value, image_count) "
+    "select 'month', to_char(time_created, 'YYYY-MM'), count(*) from images group by 1",
+]
+
+
+# Decrement the photographer and month counts for images about to be
+# replaced by a replayed upload, run before the images row is updated
+remove_images_pg_sql = [
+    "update facet_counts fc set image_count = fc.image_count - old.image_count "
+    "from (select value, count(distinct image_id) as image_count from image_metadata "
+    "where image_id = any(%(ids)s) and type = 'photographer' group by value) old "
+    "where fc.facet = 'photographer' and fc.value = old.value",
+    "update facet_counts fc set image_count = fc.image_count - old.image_count "
+    "from (select to_char(time_created, 'YYYY-MM') as value, count(*) as image_count from images "
+    "where id = any(%(ids)s) group by 1) old "
+    "where fc.facet = 'month' and fc.value = old.value",
+]
+
+
+def month_value(time_created):
+    """
+    Return the YYYY-MM month facet value for a time_created value or string
+    """
+    return str(time_created)[:7]
+
+
+def image_deltas(tags=(), photographer=None, time_created=None, delta=1):
+    """
+    Return the facet changes for adding (delta=1) or removing (delta=-1)
+    an image with the given tags, photographer and time created
+    """
+    deltas = Counter()
+    for tag in tags:
+        deltas[(TAG, tag)] += delta
+    if photographer is not None:
+        deltas[(PHOTOGRAPHER, photographer)] += delta
+    if time_created is not None:
+        deltas[(MONTH, month_value(time_created))] += delta
+    return deltas
+
+
+def param_sets(deltas):
+    return [
+        {'facet': facet, 'value': value, 'delta': delta}
+        for (facet, value), delta in sorted(deltas.items())
+        if delta != 0
+    ]
+
+
+def apply(backend, deltas):
+    """
+    Apply facet changes with a photo_archive.backends backend
+    """
+    backend.execute_batch(upsert_sql, param_sets(deltas))
+
+
+def apply_pg(cur, deltas):
+    """
+    Apply facet changes with a psycopg2 cursor
+    """
+    from psycopg2.extras import execute_values
+
+    rows = [(params['facet'], params['value'], params['delta']) for params in param_sets(deltas)]
+    if len(rows) == 0:
+        return
+    execute_values(
+        cur,
+        "insert into facet_counts (facet, value, image_count) values %s "
+        "on conflict (facet, value) do update "
+        "set image_count = facet_counts.image_count + excluded.image_count",
+        rows
+    )
+
+
+def remove_images_pg(cur, image_ids):
+    """
+    Remove images' photographer and month counts with a psycopg2 cursor
+    """
+    if len(image_ids) == 0:
+        return
+    for sql in remove_images_pg_sql:
+        cur.execute(sql, {'ids': list(image_ids)})
+
+
+def rebuild_pg(cur):
+    """
+    Recreate all counts with a psycopg2 cursor, in the caller's transaction
+    """
+    for sql in rebuild_sql:
+        cur.execute(sql)
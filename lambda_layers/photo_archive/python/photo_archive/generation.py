@@ -0,0 +1,68 @@
+"""
+Generating a missing rendition from its original, guarded by a lock object
+under locks/ in the bucket so only one request (or function) across all
+instances does the work. The bucket should have a lifecycle rule expiring
+objects under that prefix.
+
+Pillow is only imported once a rendition is actually generated.
+"""
+import io
+
+from datetime import datetime, timezone
+
+import botocore
+
+from photo_archive import metrics, renditions
+
+# A lock older than this is assumed to have been left by a failed request
+lock_seconds = 120
+
+
+def acquire_lock(s3_client, bucket, image_key):
+    """
+    Take the lock object for generating a rendition, returns False if
+    another request holds it. A stale lock is taken over.
+    """
+    lock_key = 'locks/' + image_key
+    for attempt in range(2):
+        try:
+            s3_client.put_object(Bucket=bucket, Key=lock_key, Body=b'', IfNoneMatch='*')
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+
+        try:
+            lock = s3_client.head_object(Bucket=bucket, Key=lock_key)
+        except botocore.exceptions.ClientError:
+            # Released since the put failed, try again
+            continue
+        lock_age = datetime.now(timezone.utc) - lock['LastModified']
+        if lock_age.total_seconds() < lock_seconds:
+            return False
+        s3_client.delete_object(Bucket=bucket, Key=lock_key)
+    return False
+
+
+def release_lock(s3_client, bucket, image_key):
+    s3_client.delete_object(Bucket=bucket, Key='locks/' + image_key)
+
+
+def generate(s3_client, bucket, image_type, year, month, id):
+    """
+    Create a rendition from the original, without taking the lock
+    """
+    source_key = renditions.original_key(year, month, id)
+    original = io.BytesIO()
+    with metrics.stage('download'):
+        s3_client.download_fileobj(bucket, source_key, original)
+    original.seek(0)
+
+    renditions.upload_renditions(
+        s3_client,
+        bucket,
+        year,
+        month,
+        id,
+        renditions.generate_renditions(original, [image_type])
+    )
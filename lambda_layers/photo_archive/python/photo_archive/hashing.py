@@ -0,0 +1,51 @@
+"""
+Content and perceptual hashes used to find duplicate images.
+"""
+import hashlib
+import io
+
+from photo_archive import metrics
+
+chunk_size = 1024 * 1024
+
+
+def download_with_hash(s3_client, bucket, key):
+    """
+    Download an object into memory, computing its SHA-256 as it streams.
+    Returns (file object positioned at the start, hex digest).
+    """
+    content_hash = hashlib.sha256()
+    data = io.BytesIO()
+    with metrics.stage('download'):
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        for chunk in response['Body'].iter_chunks(chunk_size):
+            content_hash.update(chunk)
+            data.write(chunk)
+    data.seek(0)
+    return data, content_hash.hexdigest()
+
+
+def dhash(image, hash_size=8):
+    """
+    Return the difference hash of a PIL image as a signed 64 bit int (to
+    fit a Postgres bigint). Each bit records whether a pixel of a tiny
+    greyscale copy is brighter than its right neighbour, so re-encoded or
+    resized copies of a photo have hashes a small Hamming distance apart.
+    """
+    from PIL import Image
+
+    small = image.resize((hash_size + 1, hash_size), Image.BILINEAR, reducing_gap=2.0).convert('L')
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def hamming_distance(a, b):
+    return bin((a ^ b) & ((1 << 64) - 1)).count('1')
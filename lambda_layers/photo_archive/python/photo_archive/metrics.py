@@ -0,0 +1,129 @@
+"""
+Per-invocation timings and counts, written as one CloudWatch embedded
+metric format (EMF) JSON line at the end of each invocation.
+
+Wrap a handler with @metrics.handler('function_name') and time work with
+"with metrics.stage('decode'):". AWS client calls are timed per operation
+(e.g. s3.GetObject, rds-data.ExecuteStatement) once the client is passed
+to metrics.instrument(), and statements on photo_archive.db connections
+are timed as 'db'. Stages can overlap (a download includes its GetObject
+call) and are summed across threads.
+
+METRICS_SAMPLE_RATE (0-1, default 1) is the fraction of warm invocations
+that emit a line, cold starts are always emitted.
+"""
+import functools
+import json
+import os
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+
+namespace = os.environ.get('METRICS_NAMESPACE', 'PhotoArchive')
+sample_rate = float(os.environ.get('METRICS_SAMPLE_RATE', '1'))
+
+cold_start = True
+
+lock = threading.Lock()
+# Stage name to [total milliseconds, count]
+stages = {}
+# Count name to total
+counts = {}
+
+
+def add(stage, millis):
+    with lock:
+        totals = stages.setdefault(stage, [0.0, 0])
+        totals[0] += millis
+        totals[1] += 1
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, (time.perf_counter() - start) * 1000)
+
+
+def count(name, value=1):
+    with lock:
+        counts[name] = counts.get(name, 0) + value
+
+
+def instrument(client):
+    """
+    Time every API call made by a boto3 client, by service and operation
+    """
+    service = client.meta.service_model.service_name
+
+    def before_call(context, **kwargs):
+        context['metrics_start'] = time.perf_counter()
+
+    def after_call(model, context, **kwargs):
+        start = context.get('metrics_start')
+        if start is not None:
+            add('{service}.{operation}'.format(service=service, operation=model.name), (time.perf_counter() - start) * 1000)
+
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('after-call', after_call)
+    return client
+
+
+def emf_line(function_name, duration_millis, was_cold):
+    with lock:
+        stage_totals = {name: list(totals) for name, totals in stages.items()}
+        count_totals = dict(counts)
+
+    record = {
+        'Function': function_name,
+        'ColdStart': was_cold,
+        'duration': round(duration_millis, 3),
+    }
+    definitions = [{'Name': 'duration', 'Unit': 'Milliseconds'}]
+    for name, (millis, calls) in sorted(stage_totals.items()):
+        record[name] = round(millis, 3)
+        record[name + '.calls'] = calls
+        definitions.append({'Name': name, 'Unit': 'Milliseconds'})
+        definitions.append({'Name': name + '.calls', 'Unit': 'Count'})
+    for name, value in sorted(count_totals.items()):
+        record[name] = value
+        definitions.append({'Name': name, 'Unit': 'Count'})
+
+    record['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{
+            'Namespace': namespace,
+            'Dimensions': [['Function']],
+            'Metrics': definitions,
+        }],
+    }
+    return json.dumps(record, separators=(',', ':'), default=str)
+
+
+def handler(function_name):
+    """
+    Decorator for a lambda_handler that resets the recorded metrics at the
+    start of each invocation and emits them when it returns or raises
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(event, context):
+            global cold_start
+
+            with lock:
+                stages.clear()
+                counts.clear()
+            was_cold = cold_start
+            cold_start = False
+            start = time.perf_counter()
+            try:
+                return fn(event, context)
+            finally:
+                if was_cold or random.random() < sample_rate:
+                    print(emf_line(function_name, (time.perf_counter() - start) * 1000, was_cold))
+        return wrapper
+    return decorator
@@ -0,0 +1,263 @@
+"""
+Rendition specs and keys, and the resize/encode pipeline. Pillow is
+imported when an image is first opened or resized, so functions that only
+need keys (e.g. to sign URLs) don't pay for it at cold start.
+"""
+import base64
+import io
+import os
+
+from photo_archive import metrics
+
+image_longest_sides = {'thumbnail': 500, 'standard': 2000}
+
+# Output settings for each rendition, save_options are passed to Pillow.
+# JPEGs are saved at Pillow's default quality of 75, baseline, as they were
+# before the renditions were shared, so their size and encode time don't
+# change. Smaller files come from the variants below.
+rendition_specs = {
+    'standard': {
+        'folder': 'standard',
+        'longest_side': image_longest_sides['standard'],
+        'format': 'JPEG',
+        'extension': 'jpg',
+        'content_type': 'image/jpeg',
+        'save_options': {'quality': 75},
+    },
+    'thumbnail': {
+        'folder': 'thumbnails',
+        'longest_side': image_longest_sides['thumbnail'],
+        'format': 'JPEG',
+        'extension': 'jpg',
+        'content_type': 'image/jpeg',
+        'save_options': {'quality': 75},
+    },
+}
+
+# Variants in more efficient formats at a ladder of sizes (longest side),
+# so clients can request the smallest that covers their display. The
+# default ladder includes the thumbnail and standard sizes so each has a
+# same sized variant. The functions that generate renditions and
+# photo_access must be deployed with the same settings. avif is dropped
+# unless Pillow supports it (11.2+ built with libavif), checking that loads
+# Pillow so it's only done when avif is configured.
+variant_format_specs = {
+    'avif': {
+        'format': 'AVIF',
+        'extension': 'avif',
+        'content_type': 'image/avif',
+        'save_options': {'quality': 55, 'speed': 6},
+    },
+    'webp': {
+        'format': 'WEBP',
+        'extension': 'webp',
+        'content_type': 'image/webp',
+        'save_options': {'quality': 78, 'method': 4},
+    },
+    'jpeg': {
+        'format': 'JPEG',
+        'extension': 'jpg',
+        'content_type': 'image/jpeg',
+        'save_options': {'quality': 75},
+    },
+}
+
+
+def format_supported(image_format):
+    if image_format != 'avif':
+        return True
+    try:
+        from PIL import features
+    except ImportError:
+        return False
+    return features.check('avif')
+
+
+variant_formats = [
+    image_format.strip()
+    for image_format in os.environ.get('RENDITION_FORMATS', 'webp').split(',')
+    if image_format.strip() in variant_format_specs and format_supported(image_format.strip())
+]
+variant_sizes = sorted(
+    int(size)
+    for size in os.environ.get('RENDITION_SIZES', '320,500,1000,2000').split(',')
+    if size.strip()
+)
+
+
+def variant_type(image_format, size):
+    return '{image_format}-{size}'.format(image_format=image_format, size=size)
+
+
+for variant_format in variant_formats:
+    for variant_size in variant_sizes:
+        rendition_specs[variant_type(variant_format, variant_size)] = dict(
+            variant_format_specs[variant_format],
+            folder='{image_format}/{size}'.format(image_format=variant_format, size=variant_size),
+            longest_side=variant_size,
+        )
+
+# A tiny, low quality JPEG returned inline with search results (as
+# base64) so the gallery can draw each image blurred at the right aspect
+# ratio before its thumbnail loads
+placeholder_longest_side = 16
+placeholder_quality = 40
+
+# Resize in two steps (integer reduce then bicubic) when downscaling by more
+# than this factor, much faster than a single bicubic pass with very similar
+# output
+reducing_gap = 3.0
+
+
+def original_key(year, month, id):
+    return 'originals/{year}/{month}/{id}.jpg'.format(
+        year = year,
+        month = month,
+        id = id
+    )
+
+
+def rendition_key(image_type, year, month, id):
+    spec = rendition_specs[image_type]
+    return '{folder}/{year}/{month}/{id}.{extension}'.format(
+        folder = spec['folder'],
+        year = year,
+        month = month,
+        id = id,
+        extension = spec['extension']
+    )
+
+
+def new_size(size, new_longest_side):
+    width, height = size
+
+    # If the current longest side is less than or equal to the new longest side
+    # then we don't need to do any resizing, return current size
+    if max(width, height) <= new_longest_side:
+        return size
+
+    ratio = height / width
+    if width > height:
+        return (new_longest_side, round(new_longest_side * ratio))
+    return (round(new_longest_side / ratio), new_longest_side)
+
+
+def resize(image, image_type):
+    from PIL import Image
+
+    size = new_size(image.size, rendition_specs[image_type]['longest_side'])
+    if size == image.size:
+        return image
+    with metrics.stage('resize'):
+        return image.resize(size, Image.BICUBIC, reducing_gap=reducing_gap)
+
+
+def open_original(source, image_types=None):
+    """
+    Open an original image (a path or file object) ready for rendering.
+    For JPEGs the decoder is put into draft mode so it only decodes at
+    the smallest DCT scale still larger than the biggest rendition needed.
+    Pixel data isn't decoded until the image is rendered, so EXIF data
+    can be read from the returned image cheaply. The size before draft
+    mode is kept in image.info['full_size'].
+    """
+    from PIL import Image
+
+    if image_types is None:
+        image_types = list(rendition_specs)
+
+    image = Image.open(source)
+    image.info['full_size'] = image.size
+    if image.format == 'JPEG':
+        largest = max(rendition_specs[image_type]['longest_side'] for image_type in image_types)
+        image.draft('RGB', new_size(image.size, largest))
+    return image
+
+
+def encode(image, image_type):
+    spec = rendition_specs[image_type]
+    buffer = io.BytesIO()
+    with metrics.stage('encode'):
+        image.save(
+            buffer,
+            format=spec['format'],
+            **spec['save_options']
+        )
+    return buffer.getvalue()
+
+
+def placeholder(image):
+    """
+    Return a base64 JPEG placeholder for an image, resized from the
+    smallest rendition rather than the original
+    """
+    from PIL import Image
+
+    size = new_size(image.size, placeholder_longest_side)
+    with metrics.stage('resize'):
+        small = image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    buffer = io.BytesIO()
+    small.save(buffer, format='JPEG', quality=placeholder_quality, optimize=True)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def render(image, image_types=None):
+    """
+    Decode an opened original once and return a dict of image type to
+    encoded rendition bytes. Orientation is applied before resizing and
+    each rendition is resized from the previous (larger) one.
+    """
+    return render_with_details(image, image_types)[0]
+
+
+def render_with_details(image, image_types=None):
+    """
+    Render an opened original as render() does, returning (renditions,
+    details) where details has the pixel width and height of the oriented
+    original (not of the reduced scale it was decoded at) and its
+    placeholder
+    """
+    from PIL import ImageOps
+
+    if image_types is None:
+        image_types = list(rendition_specs)
+
+    width, height = image.info.get('full_size', image.size)
+    # Orientations 5-8 rotate the image a quarter turn
+    if image.getexif().get(0x0112) in (5, 6, 7, 8):
+        width, height = height, width
+
+    with metrics.stage('decode'):
+        image.load()
+    current = ImageOps.exif_transpose(image)
+    if current.mode not in ('RGB', 'L'):
+        current = current.convert('RGB')
+
+    ordered_types = sorted(
+        image_types,
+        key=lambda image_type: rendition_specs[image_type]['longest_side'],
+        reverse=True
+    )
+    details = {'width': width, 'height': height}
+    renditions = {}
+    for image_type in ordered_types:
+        current = resize(current, image_type)
+        renditions[image_type] = encode(current, image_type)
+    details['placeholder'] = placeholder(current)
+    return renditions, details
+
+
+def generate_renditions(source, image_types=None):
+    with open_original(source, image_types) as image:
+        return render(image, image_types)
+
+
+def upload_renditions(s3_client, bucket, year, month, id, renditions):
+    for image_type, data in renditions.items():
+        with metrics.stage('upload'):
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=rendition_key(image_type, year, month, id),
+                Body=data,
+                ContentType=rendition_specs[image_type]['content_type'],
+            )
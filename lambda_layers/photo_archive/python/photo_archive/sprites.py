@@ -0,0 +1,71 @@
+"""
+Contact sheet sprites: a page of thumbnails packed into one image, with a
+map of where each image is, so a page of results can be drawn from a
+single fetch. Sprites are cached in S3 under sprites/ by a hash of the
+image ids and sprite settings, the bucket should have a lifecycle rule
+expiring objects under that prefix.
+
+Pillow is only imported when a sprite is built.
+"""
+import hashlib
+import io
+import math
+
+from photo_archive import metrics, renditions
+
+# Encoder settings are shared with the rendition variants
+sprite_formats = ['webp', 'jpeg']
+
+background = (238, 238, 238)
+
+
+def sprite_key(image_ids, cell_size, image_format):
+    digest = hashlib.sha256(
+        '\n'.join([image_format, str(cell_size)] + list(image_ids)).encode()
+    ).hexdigest()
+    return 'sprites/{digest}.{extension}'.format(
+        digest = digest[:40],
+        extension = renditions.variant_format_specs[image_format]['extension']
+    )
+
+
+def map_key(key):
+    return key + '.json'
+
+
+def build(thumbnails, cell_size, image_format):
+    """
+    Pack thumbnails, a list of (image id, encoded image bytes), into a grid
+    of cell_size squares, each image scaled to fit its cell and centred.
+    Returns (encoded sprite, map) where the map has the sprite's width and
+    height and images, a dict of image id to [x, y, width, height].
+    """
+    from PIL import Image
+
+    columns = max(1, math.ceil(math.sqrt(len(thumbnails))))
+    rows = max(1, math.ceil(len(thumbnails) / columns))
+    sprite = Image.new('RGB', (columns * cell_size, rows * cell_size), background)
+    positions = {}
+    for index, (image_id, data) in enumerate(thumbnails):
+        with Image.open(io.BytesIO(data)) as image:
+            # Thumbnails are already oriented, thumbnail() decodes JPEGs
+            # at a reduced scale where it can
+            with metrics.stage('resize'):
+                image.thumbnail((cell_size, cell_size), Image.BICUBIC)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            x = (index % columns) * cell_size + (cell_size - image.width) // 2
+            y = (index // columns) * cell_size + (cell_size - image.height) // 2
+            sprite.paste(image, (x, y))
+            positions[image_id] = [x, y, image.width, image.height]
+
+    spec = renditions.variant_format_specs[image_format]
+    buffer = io.BytesIO()
+    with metrics.stage('encode'):
+        sprite.save(buffer, format=spec['format'], **spec['save_options'])
+    sprite_map = {
+        'width': sprite.width,
+        'height': sprite.height,
+        'images': positions,
+    }
+    return buffer.getvalue(), sprite_map
@@ -0,0 +1,281 @@
+"""
+Generate missing or outdated renditions for every original in the archive,
+without going through image_process_queue (which also re-reads EXIF and
+rewrites metadata, 30 images per run).
+
+The rendition folders are listed once, then originals/ is listed page by
+page and each original missing a rendition, or with one older than the
+original (or than --since, to regenerate after a spec change), is sent to
+a process pool. Each original is downloaded and decoded once for all of
+its renditions.
+
+Originals are listed in key order and the checkpoint file records the last
+key before which every original has been handled, so an interrupted run
+started again with the same options continues from there. The checkpoint
+is removed when a run finishes. Originals that fail are reported, and as
+their renditions are still missing or outdated the next full run retries
+them.
+
+Usage: python tools/backfill_renditions.py [--types thumbnail,standard]
+    [--since 2024-05-01T00:00:00] [--workers N] [--checkpoint FILE]
+    [--dry-run]
+"""
+import argparse
+import concurrent.futures
+import io
+import json
+import os
+import re
+import sys
+import time
+
+from collections import deque
+from datetime import datetime, timezone
+
+import boto3
+
+here = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(here, '..', 'lambda_layers', 'photo_archive', 'python'))
+
+from photo_archive import renditions
+
+bucket = 'peteandrew-photoarchive-eu'
+
+original_key_pattern = re.compile(r'^originals/(?P<year>[^/]+)/(?P<month>[^/]+)/(?P<id>[^/]+)\.jpg$')
+
+# Originals submitted to the pool ahead of those being processed
+queue_per_worker = 4
+
+checkpoint_interval_seconds = 10
+
+s3_client = None
+
+
+def list_objects(client, prefix, **kwargs):
+    """
+    Yield each object under a prefix, in key order
+    """
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, **kwargs):
+        yield from page.get('Contents', [])
+
+
+def existing_renditions(client, image_types):
+    """
+    Return a dict of rendition key to last modified time for the image types
+    """
+    existing = {}
+    folders = {renditions.rendition_specs[image_type]['folder'] for image_type in image_types}
+    for folder in sorted(folders):
+        for obj in list_objects(client, folder + '/'):
+            existing[obj['Key']] = obj['LastModified']
+    return existing
+
+
+def outdated_types(original, image_types, existing, since):
+    """
+    Return the image types of an original's renditions that are missing or
+    older than the original or since
+    """
+    match = original_key_pattern.match(original['Key'])
+    outdated = []
+    for image_type in image_types:
+        modified = existing.get(renditions.rendition_key(image_type, match['year'], match['month'], match['id']))
+        if modified is None or modified < original['LastModified'] or (since is not None and modified < since):
+            outdated.append(image_type)
+    return outdated
+
+
+def init_worker():
+    global s3_client
+    s3_client = boto3.client('s3', region_name='eu-west-2')
+
+
+def backfill(source_key, image_types):
+    """
+    Generate and upload renditions of one original, run in a pool worker.
+    Returns (source key, error message or None).
+    """
+    match = original_key_pattern.match(source_key)
+    try:
+        original = io.BytesIO()
+        s3_client.download_fileobj(bucket, source_key, original)
+        original.seek(0)
+        renditions.upload_renditions(
+            s3_client,
+            bucket,
+            match['year'],
+            match['month'],
+            match['id'],
+            renditions.generate_renditions(original, image_types)
+        )
+    except Exception as e:
+        return source_key, '{name}: {error}'.format(name = type(e).__name__, error = e)
+    return source_key, None
+
+
+class Checkpoint:
+    """
+    The last original key before which every original has been handled, and
+    the options of the run that wrote it
+    """
+    def __init__(self, path, options):
+        self.path = path
+        self.options = options
+        self.after = None
+        self.written = time.monotonic()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path) as f:
+            saved = json.load(f)
+        if saved['options'] != self.options:
+            raise SystemExit(
+                f'{self.path} was written by a run with different options, '
+                'remove it to start again'
+            )
+        self.after = saved['after']
+
+    def save(self, after, force=False):
+        self.after = after
+        if not force and time.monotonic() - self.written < checkpoint_interval_seconds:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'options': self.options, 'after': after}, f)
+        os.replace(temp_path, self.path)
+        self.written = time.monotonic()
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def parse_since(value):
+    since = datetime.fromisoformat(value)
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return since
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--types',
+        default=','.join(renditions.rendition_specs),
+        help='comma separated image types (default all: %(default)s)'
+    )
+    parser.add_argument('--since', type=parse_since, help='also regenerate renditions older than this ISO time')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes (default CPU count)')
+    parser.add_argument('--checkpoint', default='backfill_renditions.checkpoint', help='checkpoint file')
+    parser.add_argument('--dry-run', action='store_true', help='count what would be generated')
+    args = parser.parse_args()
+
+    image_types = [image_type.strip() for image_type in args.types.split(',') if image_type.strip()]
+    unknown = [image_type for image_type in image_types if image_type not in renditions.rendition_specs]
+    if unknown:
+        parser.error('unknown image types: ' + ', '.join(unknown))
+
+    client = boto3.client('s3', region_name='eu-west-2')
+    checkpoint = Checkpoint(args.checkpoint, {
+        'types': sorted(image_types),
+        'since': args.since.isoformat() if args.since else None,
+    })
+    if not args.dry_run:
+        checkpoint.load()
+        if checkpoint.after is not None:
+            print(f'Resuming after {checkpoint.after}')
+
+    started = time.monotonic()
+    existing = existing_renditions(client, image_types)
+    print(f'{len(existing)} existing renditions listed in {time.monotonic() - started:.1f}s')
+
+    originals = (
+        obj
+        for obj in list_objects(client, 'originals/', **({'StartAfter': checkpoint.after} if checkpoint.after else {}))
+        if original_key_pattern.match(obj['Key'])
+    )
+
+    if args.dry_run:
+        scanned = 0
+        type_counts = dict.fromkeys(image_types, 0)
+        for original in originals:
+            scanned += 1
+            for image_type in outdated_types(original, image_types, existing, args.since):
+                type_counts[image_type] += 1
+        print(f'{scanned} originals')
+        for image_type, count in type_counts.items():
+            print(f'  {image_type}: {count} to generate')
+        return
+
+    # Keys in listing order that have been submitted or skipped, with
+    # whether each is done, so the checkpoint only moves past a key once
+    # every key before it is done
+    order = deque()
+    done = {}
+    scanned = 0
+    generated = 0
+    failed = 0
+
+    def advance():
+        after = None
+        while order and done[order[0]]:
+            after = order.popleft()
+            del done[after]
+        if after is not None:
+            checkpoint.save(after)
+
+    def collect(finished):
+        nonlocal generated, failed
+        for future in finished:
+            source_key, error = future.result()
+            done[source_key] = True
+            if error is None:
+                generated += 1
+            else:
+                failed += 1
+                print(f'{source_key} failed: {error}')
+
+    max_pending = args.workers * queue_per_worker
+    pending = set()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker) as executor:
+            for original in originals:
+                scanned += 1
+                order.append(original['Key'])
+                outdated = outdated_types(original, image_types, existing, args.since)
+                done[original['Key']] = not outdated
+                if outdated:
+                    pending.add(executor.submit(backfill, original['Key'], outdated))
+
+                if len(pending) >= max_pending:
+                    finished, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(finished)
+                advance()
+
+                if scanned % 1000 == 0:
+                    print(
+                        f'{scanned} originals scanned, {generated} generated, {failed} failed, '
+                        f'{time.monotonic() - started:.0f}s'
+                    )
+
+            finished, pending = concurrent.futures.wait(pending)
+            collect(finished)
+            advance()
+    except KeyboardInterrupt:
+        if checkpoint.after is not None:
+            checkpoint.save(checkpoint.after, force=True)
+        raise SystemExit(f'Interrupted, {generated} generated, run again to resume')
+
+    checkpoint.remove()
+    print(
+        f'{scanned} originals scanned, {generated} generated, {failed} failed '
+        f'in {time.monotonic() - started:.0f}s'
+    )
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
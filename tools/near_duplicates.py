@@ -0,0 +1,108 @@
+"""
+Report groups of images whose perceptual hashes are within a Hamming
+distance of each other: re-encoded, resized or lightly edited copies of the
+same photo. Exact copies are skipped at ingest by content hash, images
+imported before hashes were recorded have none and aren't compared.
+
+Hashes are split into distance + 1 bands; two hashes within the distance
+must agree on at least one band, so only images sharing a band are compared
+rather than every pair.
+
+Usage: DB_CONN='...' python tools/near_duplicates.py [--distance 4] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+
+import psycopg2
+
+here = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(here, '..', 'lambda_layers', 'photo_archive', 'python'))
+
+from photo_archive.hashing import hamming_distance
+
+hash_bits = 64
+
+
+def bands(value, count):
+    """
+    Yield (band number, bits) for count roughly equal bands of a hash
+    """
+    value &= (1 << hash_bits) - 1
+    start = 0
+    for band in range(count):
+        width = hash_bits // count + (1 if band < hash_bits % count else 0)
+        yield band, (value >> start) & ((1 << width) - 1)
+        start += width
+
+
+def near_duplicate_groups(hashes, distance):
+    """
+    Return lists of image ids, each a connected group of images whose hashes
+    are within distance of another in the group. hashes maps id to hash.
+    """
+    buckets = {}
+    for image_id, value in hashes.items():
+        for band in bands(value, distance + 1):
+            buckets.setdefault(band, []).append(image_id)
+
+    # Union-find over the matching pairs
+    parent = {}
+
+    def find(image_id):
+        while parent.get(image_id, image_id) != image_id:
+            image_id = parent[image_id]
+        return image_id
+
+    for ids in buckets.values():
+        for i, a in enumerate(ids):
+            for b in ids[i + 1:]:
+                if find(a) != find(b) and hamming_distance(hashes[a], hashes[b]) <= distance:
+                    parent[find(a)] = find(b)
+
+    groups = {}
+    for image_id in parent:
+        groups.setdefault(find(image_id), set()).add(image_id)
+    for root, group in groups.items():
+        group.add(root)
+    return [sorted(group) for group in groups.values()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--distance', type=int, default=4, help='maximum differing bits (default 4)')
+    parser.add_argument('--json', action='store_true', help='output groups as JSON')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DB_CONN'])
+    with conn.cursor() as cur:
+        cur.execute(
+            "select id, perceptual_hash, time_created, source_key from images "
+            "where perceptual_hash is not null"
+        )
+        records = cur.fetchall()
+    conn.close()
+
+    hashes = {record[0]: record[1] for record in records}
+    details = {record[0]: (str(record[2]), record[3]) for record in records}
+    groups = sorted(near_duplicate_groups(hashes, args.distance), key=len, reverse=True)
+
+    if args.json:
+        print(json.dumps([
+            [{'id': image_id, 'timeCreated': details[image_id][0], 'sourceKey': details[image_id][1]}
+             for image_id in group]
+            for group in groups
+        ], indent=2))
+        return
+
+    print(f'{len(groups)} groups of near-duplicates among {len(hashes)} hashed images')
+    for group in groups:
+        print()
+        for image_id in group:
+            time_created, source_key = details[image_id]
+            print(f'  {image_id}  {time_created}  {source_key}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+"""
+Recreate the tag, photographer and month image counts in facet_counts from
+the image tables. Run once after creating facet_counts to populate it for
+the existing archive, and again whenever the counts may have drifted.
+
+Usage: DB_CONN='...' python tools/rebuild_facets.py
+"""
+import argparse
+import os
+import sys
+
+import psycopg2
+
+here = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(here, '..', 'lambda_layers', 'photo_archive', 'python'))
+
+from photo_archive import facets
+
+
+def main():
+    argparse.ArgumentParser(description=__doc__.split('\n\n')[0]).parse_args()
+
+    conn = psycopg2.connect(os.environ['DB_CONN'])
+    with conn:
+        with conn.cursor() as cur:
+            facets.rebuild_pg(cur)
+            cur.execute("select facet, count(*), coalesce(sum(image_count), 0) from facet_counts group by facet order by facet")
+            rows = cur.fetchall()
+    conn.close()
+
+    for facet, values, image_count in rows:
+        print(f'{facet}: {values} values, {image_count} image counts')
+
+
+if __name__ == '__main__':
+    main()